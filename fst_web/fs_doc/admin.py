@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 """Layout and behavior of fs_doc admin app"""
-from itertools import chain
-from operator import attrgetter
+from itertools import groupby
+from operator import itemgetter
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import InvalidPage, Paginator
 from django.db import models
 from django import forms
 from django.contrib import admin
+from django.core.urlresolvers import reverse
+from django.http import Http404
 from django.shortcuts import render_to_response
 from fst_web.adminplus.sites import AdminSitePlus
+from fst_web.fs_doc.cache import page_cache
 
 from fst_web.fs_doc.models import AllmannaRad
 from fst_web.fs_doc.models import Amnesord
@@ -15,15 +20,17 @@ from fst_web.fs_doc.models import Bemyndigandereferens
 from fst_web.fs_doc.models import Bilaga
 from fst_web.fs_doc.models import CelexReferens
 from fst_web.fs_doc.models import Forfattningssamling
+from fst_web.fs_doc.models import FSDokument
 from fst_web.fs_doc.models import KonsolideradForeskrift
 from fst_web.fs_doc.models import Myndighet
 from fst_web.fs_doc.models import Myndighetsforeskrift
 from fst_web.fs_doc.models import RDFPost
 from fst_web.fs_doc.models import OvrigtDokument
 from fst_web.fs_doc.models import to_slug
-from fst_web.fs_doc.models import get_file_md5
 from fst_web.fs_doc.models import generate_atom_entry_for
 from fst_web.fs_doc.models import generate_rdf_post_for
+from fst_web.fs_doc.models import next_lopnummer
+from fst_web.fs_doc.models import publish_documents
 
 # Adminplus fails to add these, so we must do it ourselves
 from django.contrib.auth.admin import User, Group, UserAdmin
@@ -67,22 +74,7 @@ class BemyndigandereferensAdmin(admin.ModelAdmin):
     search_fields = ('titel', 'sfsnummer',)
 
 
-class HasFileForm(forms.ModelForm):
-    FILE_FIELD_KEY = 'file'
-
-    def save(self, commit=True):
-        m = super(HasFileForm, self).save(commit=False)
-        file_field = self.cleaned_data[self.FILE_FIELD_KEY]
-        file_md5_key = '%s_md5' % self.FILE_FIELD_KEY
-        if file_field:
-            setattr(m, file_md5_key, get_file_md5(file_field.file))
-        if commit:
-            m.save()
-        return m
-
-
 class HasFileInline(admin.TabularInline):
-    form = HasFileForm
     extra = 1
     list_display = ('titel', 'file')
     ordering = ('titel',)
@@ -99,10 +91,6 @@ class OvrigtDokumentInline(HasFileInline):
     classes = ['collapse', 'collapsed']
 
 
-class HasContentFileForm(HasFileForm):
-    FILE_FIELD_KEY = 'content'
-
-
 class FSDokumentAdminMixin(object):
     view_on_site = False  # Hide link to raw metadata
 
@@ -127,15 +115,25 @@ class FSDokumentAdminMixin(object):
             FSDokumentAdminMixin, self).formfield_for_foreignkey(
             db_field, request, **kwargs)
 
+    def get_changeform_initial_data(self, request):
+        """Suggest next 'lopnummer' in the preselected collection"""
+
+        initial = super(FSDokumentAdminMixin,
+                        self).get_changeform_initial_data(request)
+        if 'lopnummer' not in initial:
+            initial['lopnummer'] = next_lopnummer(
+                arsutgava=initial.get('arsutgava'),
+                forfattningssamling=initial.get('forfattningssamling', 1))
+        return initial
+
     def make_published(self, request, queryset):
         """Puslish selected documents by creating Atom entries."""
 
-        for i, obj in enumerate(queryset):
-            generate_atom_entry_for(obj)
-            obj.is_published = True
-            obj.save()
-            self.message_user(
-                request, "%s dokument har publicerats." % (i + 1))
+        documents = list(queryset)
+        written = publish_documents(documents)
+        self.message_user(
+            request, "%s dokument har publicerats (%s oförändrade)." % (
+                len(documents), len(documents) - written))
 
     make_published.short_description = u"Publicera markerade dokument via FST"
     actions = [make_published]
@@ -158,8 +156,6 @@ class FSDokumentAdminMixin(object):
 
 
 class AllmannaRadAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
-    form = HasContentFileForm
-
     list_display = ('identifierare',
                     'arsutgava',
                     'lopnummer',
@@ -175,10 +171,12 @@ class AllmannaRadAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
                    # 'andrar',
                    'omtryck')
     ordering = ('-beslutsdatum', 'titel')
-    search_fields = ('titel', 'arsutgava', 'lopnummer')
+    search_fields = ('titel', 'arsutgava', 'lopnummer',
+                     'cached_identifierare')
     inlines = [BilagaInline, OvrigtDokumentInline]
     readonly_fields = ('is_published', 'identifierare',)
     save_on_top = True
+    list_select_related = ('forfattningssamling',)
     list_per_page = LIST_PER_PAGE_COUNT
     fieldsets = (
         (None,
@@ -216,6 +214,12 @@ class AllmannaRadAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
                          'upphavningar',
                          'konsolideringar')
 
+    def get_queryset(self, request):
+        """Annotate number of changed documents, used by 'role_label'"""
+
+        return super(AllmannaRadAdmin, self).get_queryset(request).annotate(
+            andringar_count=models.Count('andringar', distinct=True))
+
     def formfield_for_dbfield(self, db_field, **kwargs):
         """"Use different or modified widgets for some fields """
 
@@ -235,8 +239,6 @@ class AllmannaRadAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
 
 
 class MyndighetsforeskriftAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
-    form = HasContentFileForm
-
     list_display = ('identifierare',
                     'arsutgava',
                     'lopnummer',
@@ -252,10 +254,12 @@ class MyndighetsforeskriftAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
                    # 'andrar',
                    'omtryck')
     ordering = ('-beslutsdatum', 'titel')
-    search_fields = ('titel', 'arsutgava', 'lopnummer')
+    search_fields = ('titel', 'arsutgava', 'lopnummer',
+                     'cached_identifierare')
     inlines = [BilagaInline, OvrigtDokumentInline]
     readonly_fields = ('is_published', 'identifierare',)
     save_on_top = True
+    list_select_related = ('forfattningssamling',)
     list_per_page = LIST_PER_PAGE_COUNT
     fieldsets = (
         (None,
@@ -303,6 +307,14 @@ class MyndighetsforeskriftAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
                          'konsolideringar',
                          'celexreferenser')
 
+    def get_queryset(self, request):
+        """Annotate number of changed documents, used by 'role_label'"""
+
+        queryset = super(MyndighetsforeskriftAdmin, self).get_queryset(
+            request)
+        return queryset.annotate(
+            andringar_count=models.Count('andringar', distinct=True))
+
     def formfield_for_dbfield(self, db_field, **kwargs):
         """"Use different or modified widgets for some fields """
 
@@ -322,8 +334,6 @@ class MyndighetsforeskriftAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
 
 
 class KonsolideradForeskriftAdmin(FSDokumentAdminMixin, admin.ModelAdmin):
-    form = HasContentFileForm
-
     model = KonsolideradForeskrift
     list_display = ('identifierare',
                     'titel',
@@ -359,36 +369,91 @@ def _response(request, template, context):
                               context)
 
 
+def _report_page(request, documents):
+    """Return page of 'FSDokument' queryset requested by parameter 'p'.
+
+    Documents in the page are resolved to 'Myndighetsforeskrift' or
+    'AllmannaRad' from the same query.
+    """
+
+    documents = documents.select_related(
+        'myndighetsforeskrift', 'allmannarad', 'forfattningssamling').annotate(
+        foreskrift_andringar=models.Count(
+            'myndighetsforeskrift__andringar', distinct=True),
+        allmannarad_andringar=models.Count(
+            'allmannarad__andringar', distinct=True))
+    try:
+        page = Paginator(documents, LIST_PER_PAGE_COUNT).page(
+            request.GET.get('p', 1))
+    except InvalidPage:
+        raise Http404
+    page.object_list = [_concrete_document(doc) for doc in page.object_list]
+    return page
+
+
+def _concrete_document(doc):
+    """Return subclass object of 'FSDokument' loaded with select_related"""
+
+    for subclass, andringar_count in (
+            ('myndighetsforeskrift', doc.foreskrift_andringar),
+            ('allmannarad', doc.allmannarad_andringar)):
+        try:
+            concrete = getattr(doc, subclass)
+        except ObjectDoesNotExist:
+            continue
+        concrete.andringar_count = andringar_count
+        setattr(concrete, FSDokument.forfattningssamling.cache_name,
+                doc.forfattningssamling)
+        return concrete
+    return doc
+
+
 def amnesord(request):
-    """Display documents grouped by keywords """
-
-    def get_identifierare(obj):
-        return obj.identifierare
-
-    # Get all keywords used by at least one document
-    amnesord = list(
-        Amnesord.objects.filter(
-            fsdokument__isnull=False).order_by("titel").distinct())
-
-    # Create a dictionary on keywords for all types of documents
-    docs_by_keywords = {}
-    for kw in (amnesord):
-        doc_list = list(kw.fsdokument_set.all())
-        doc_list.sort(key=get_identifierare)
-        docs_by_keywords[kw] = doc_list
+    """Display documents grouped by keywords
+
+    All keywords used by at least one document are read together with
+    their documents in one query over the keyword-document relation.
+    """
+
+    # Admin URL of each document type, completed with the document id
+    change_urls = dict(
+        (model, reverse('admin:fs_doc_%s_changelist' % model) + "%s/change/")
+        for model in ('myndighetsforeskrift', 'allmannarad'))
+
+    rows = FSDokument.amnesord.through.objects.order_by(
+        'amnesord__titel', 'fsdokument__cached_identifierare',
+        'fsdokument__forfattningssamling__kortnamn',
+        'fsdokument__arsutgava', 'fsdokument__lopnummer').values_list(
+        'amnesord__titel', 'fsdokument_id', 'fsdokument__titel',
+        'fsdokument__cached_identifierare',
+        'fsdokument__forfattningssamling__kortnamn',
+        'fsdokument__arsutgava', 'fsdokument__lopnummer',
+        'fsdokument__myndighetsforeskrift')
+
+    docs_by_keywords = []
+    for keyword, documents in groupby(rows, itemgetter(0)):
+        doc_list = []
+        for (keyword, doc_id, titel, identifierare, kortnamn, arsutgava,
+             lopnummer, foreskrift_id) in documents:
+            model = 'myndighetsforeskrift' if foreskrift_id \
+                else 'allmannarad'
+            doc_list.append((
+                change_urls[model] % doc_id,
+                identifierare or "%s %s:%s" % (kortnamn, arsutgava,
+                                               lopnummer),
+                titel))
+        docs_by_keywords.append((keyword, doc_list))
     return _response(request, 'per_amnesord.html', locals())
 
 
 def ikrafttradande(request):
     """Display documents grouped by year """
 
-    def get_ikrafttradandedatum(obj):
-        return obj.ikrafttradandedatum
-
-    f_list = list(Myndighetsforeskrift.objects.all().filter(is_published=True))
-    a_list = list(AllmannaRad.objects.all().filter(is_published=True))
-    fs_documents = list(chain(f_list, a_list))
-    fs_documents.sort(key=get_ikrafttradandedatum, reverse=True)
+    page = _report_page(
+        request,
+        FSDokument.objects.filter(is_published=True).order_by(
+            '-ikrafttradandedatum', '-id'))
+    fs_documents = page.object_list
     return _response(request, 'per_ar.html', locals())
 
 
@@ -399,14 +464,11 @@ def beslutsdatum(request):
     Get both 'Myndighetsforeskrift' and 'AllmannaRad'.
     """
 
-    f_list = list(Myndighetsforeskrift.objects.all().filter(is_published=True))
-    a_list = list(AllmannaRad.objects.all().filter(is_published=True))
-    all_docs = sorted(
-        chain(f_list, a_list),
-        key=attrgetter('beslutsdatum'),
-        reverse=True)
-    # TODO Test pagination. Is this necessary?
-    latest_documents = all_docs[:LIST_PER_PAGE_COUNT]
+    page = _report_page(
+        request,
+        FSDokument.objects.filter(is_published=True).order_by(
+            '-beslutsdatum', '-id'))
+    latest_documents = page.object_list
     return _response(request, 'beslutsdatum.html', locals())
 
 
@@ -416,21 +478,23 @@ def not_published(request):
     List all documents that are not published
     Get both 'Myndighetsforeskrift' and 'AllmannaRad'.
     """
-    f_list = list(
-        Myndighetsforeskrift.objects.all().
-        filter(is_published=False).order_by("-beslutsdatum"))
-    a_list = list(
-        AllmannaRad.objects.all().
-        filter(is_published=False).order_by("-beslutsdatum"))
-    all_docs = sorted(
-        chain(f_list, a_list),
-        key=attrgetter('beslutsdatum'),
-        reverse=True)
-    # TODO Test pagination. Is this necessary?
-    latest_documents = all_docs[:LIST_PER_PAGE_COUNT]
+
+    page = _report_page(
+        request,
+        FSDokument.objects.filter(is_published=False).order_by(
+            '-beslutsdatum', '-id'))
+    latest_documents = page.object_list
     return _response(request, 'not_published.html', locals())
 
 
+def page_cache_stats(request):
+    """Display statistics of the cache of public views"""
+
+    cache = page_cache()
+    stats = cache.stats() if hasattr(cache, 'stats') else None
+    return _response(request, 'page_cache.html', locals())
+
+
 admin.site.register_view(
     'beslutsdatum',
     u'Senast publicerade (per beslutsdatum)',
@@ -446,11 +510,15 @@ admin.site.register_view(
     u'Ej publicerade dokument',
     view=not_published)
 
-# TODO - Fix this view so get_admin_url doesn't get called with FSDokument
-# instead of Myndighetsforeskrift or AllmannaRad
-# admin.site.register_view(
-#    'amnesord', amnesord,
-#    u'Lista föreskrifter och allmänna råd (per ämnesord)')
+admin.site.register_view(
+    'amnesord',
+    u'Lista föreskrifter och allmänna råd (per ämnesord)',
+    view=amnesord)
+
+admin.site.register_view(
+    'page_cache',
+    u'Cache för publika sidor',
+    view=page_cache_stats)
 
 admin.site.register(AllmannaRad, AllmannaRadAdmin)
 admin.site.register(Myndighetsforeskrift, MyndighetsforeskriftAdmin)
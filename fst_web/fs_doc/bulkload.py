@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Bulk loading of rows into an SQLite database.
+
+Rows are dicts of column name and value. They are inserted with
+parameterized 'executemany', one transaction per table. Used by the
+'importfeed' command and 'tools/load_db.py'.
+"""
+from collections import OrderedDict
+
+
+class DuplicateRowsError(ValueError):
+    """Rows have the same values in the columns of a unique index"""
+
+
+def quote_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def load_table(connection, table, rows):
+    """Insert rows into table in one transaction"""
+
+    # Rows may have different columns, so one statement is used for
+    # each set of columns
+    statements = OrderedDict()
+    for row in rows:
+        columns = tuple(sorted(row))
+        statements.setdefault(columns, []).append(
+            [row[column] for column in columns])
+    with connection:
+        for columns, values in statements.items():
+            connection.executemany(
+                "INSERT INTO %s (%s) VALUES (%s)" % (
+                    quote_name(table),
+                    ", ".join(quote_name(column) for column in columns),
+                    ", ".join("?" for column in columns)),
+                values)
+
+
+def get_indexes(connection, tables):
+    """Return (name, sql) for indexes on tables, except implicit ones"""
+
+    return [(name, sql) for name, table, sql in connection.execute(
+        "SELECT name, tbl_name, sql FROM sqlite_master "
+        "WHERE type = 'index' AND sql IS NOT NULL")
+            if table in tables]
+
+
+def get_unique_columns(connection, table, schema="main"):
+    """Return column tuples of the unique indexes on table, except the
+    primary key"""
+
+    unique_columns = []
+    for seq, name, unique, origin, partial in connection.execute(
+            "PRAGMA %s.index_list(%s)" % (schema, quote_name(table))):
+        if unique and origin != 'pk':
+            unique_columns.append(tuple(
+                row[2] for row in connection.execute(
+                    "PRAGMA %s.index_info(%s)" % (schema,
+                                                  quote_name(name)))))
+    return unique_columns
+
+
+def check_duplicates(connection, table, unique_columns, schema="main"):
+    """Raise DuplicateRowsError if rows of table have the same values in
+    any of 'unique_columns', a list of column tuples"""
+
+    errors = []
+    for columns in unique_columns:
+        column_list = ", ".join(quote_name(column) for column in columns)
+        duplicates = connection.execute(
+            "SELECT %s, COUNT(*) FROM %s.%s GROUP BY %s "
+            "HAVING COUNT(*) > 1" % (column_list, schema, quote_name(table),
+                                     column_list)).fetchall()
+        errors.extend("%s rows in %s with (%s) = %s" % (
+            row[-1], table, ", ".join(columns),
+            ", ".join(repr(value) for value in row[:-1]))
+            for row in duplicates)
+    if errors:
+        raise DuplicateRowsError(
+            "Duplicate rows must be removed or renumbered first:\n  " +
+            "\n  ".join(errors))
+
+
+def bulk_load(connection, data, defer_checks=False, log=None):
+    """Insert data, a dict of table name and list of rows.
+
+    With 'defer_checks', indexes on the tables are dropped while loading
+    and created again afterwards, and foreign keys are checked once when
+    all tables are loaded. Rows can then be loaded in any table order.
+    Returns foreign key violations as (table, rowid, parent table) when
+    checks are deferred, else an empty list. Raises DuplicateRowsError,
+    before creating the indexes, if rows violate a unique index.
+    """
+
+    indexes = []
+    unique_columns = {}
+    if defer_checks:
+        connection.execute("PRAGMA foreign_keys = OFF")
+        indexes = get_indexes(connection, data)
+        for table in data:
+            unique_columns[table] = get_unique_columns(connection, table)
+        with connection:
+            for name, sql in indexes:
+                connection.execute("DROP INDEX %s" % quote_name(name))
+
+    for table, rows in data.items():
+        if log:
+            log("Filling table %s (%s rows)" % (table, len(rows)))
+        load_table(connection, table, rows)
+
+    violations = []
+    if defer_checks:
+        for table in data:
+            check_duplicates(connection, table, unique_columns[table])
+        with connection:
+            for name, sql in indexes:
+                connection.execute(sql)
+        for table in data:
+            violations.extend(
+                (row[0], row[1], row[2]) for row in connection.execute(
+                    "PRAGMA foreign_key_check(%s)" % quote_name(table)))
+    return violations
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Cache of the public views 'fs_dokument', 'fs_dokument_rdf' and 'atomfeed'.
+
+Responses are kept in the cache named by 'FST_PAGE_CACHE' until they are
+invalidated, when documents, or documents they link to, are published or
+deleted. Any Django cache backend can be used. 'LRUMemoryCache' keeps
+responses in the process, bounded in number and size, and counts hits,
+misses and evictions.
+"""
+
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.db import transaction
+from django.http import HttpResponse
+
+# Entries, statistics and locks of each 'LRUMemoryCache', by location.
+# Shared by the cache objects of all threads.
+_entries = {}
+_stats = {}
+_locks = {}
+
+
+class LRUMemoryCache(BaseCache):
+    """Local memory cache evicting the least recently used entries.
+
+    Entries are evicted when there are more than OPTIONS 'MAX_ENTRIES'
+    (default 300), or when their pickled size exceeds 'MAX_SIZE' bytes
+    (default no limit).
+    """
+
+    def __init__(self, name, params):
+        super(LRUMemoryCache, self).__init__(params)
+        self._max_size = params.get('OPTIONS', {}).get('MAX_SIZE')
+        self._entries = _entries.setdefault(name, OrderedDict())
+        self._stats = _stats.setdefault(name, dict.fromkeys(
+            ('hits', 'misses', 'evictions', 'size'), 0))
+        self._lock = _locks.setdefault(name, threading.RLock())
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            pickled = self._get(key)
+            if pickled is None:
+                self._stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+        return pickle.loads(pickled)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._delete(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            return self._get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats['size'] = 0
+
+    def stats(self):
+        """Return dict of hits, misses, evictions, entries and size"""
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / requests if requests \
+            else None
+        stats['max_entries'] = self._max_entries
+        stats['max_size'] = self._max_size
+        return stats
+
+    def _get(self, key):
+        """Return pickled value of key, or None if missing or expired"""
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        pickled, expiry = entry
+        if expiry is not None and expiry <= time.time():
+            self._delete(key)
+            return None
+        return pickled
+
+    def _set(self, key, value, timeout):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._delete(key)
+        self._entries[key] = (pickled, self.get_backend_timeout(timeout))
+        self._stats['size'] += len(pickled)
+        while self._entries and (
+                len(self._entries) > self._max_entries or
+                self._max_size and self._stats['size'] > self._max_size):
+            oldest_key = next(iter(self._entries))
+            self._delete(oldest_key)
+            self._stats['evictions'] += 1
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._stats['size'] -= len(entry[0])
+
+
+def page_cache():
+    """Return cache of public views, or None if caching is off"""
+
+    if not settings.FST_PAGE_CACHE:
+        return None
+    return caches[settings.FST_PAGE_CACHE]
+
+
+def page_key(view_name, *args):
+    """Return cache key of the response of 'view_name' for 'args'"""
+
+    key = "|".join((view_name,) + args)
+    return "fst_page:%s:%s" % (view_name,
+                               hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def cached_page(view_name):
+    """Decorate view to keep its responses in the page cache.
+
+    Only complete responses (status 200, not streamed) are kept, with
+    their headers, so that ETag and Last-Modified are sent for cached
+    responses too.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            cache = page_cache()
+            if cache is None or request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            key = page_key(view_name, *(
+                args + tuple(kwargs[name] for name in sorted(kwargs))))
+            cached = cache.get(key)
+            if cached is not None:
+                content, headers = cached
+                response = HttpResponse(content)
+                for header, value in headers:
+                    response[header] = value
+                return response
+            response = view(request, *args, **kwargs)
+            if response is not None and response.status_code == 200 and \
+                    not response.streaming:
+                cache.set(key, (response.content, list(response.items())))
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate_pages(keys):
+    """Remove cached responses, now and when the transaction commits.
+
+    Removing them again on commit makes sure that a response cached
+    from another request before the commit is not kept.
+    """
+
+    cache = page_cache()
+    if cache is None or not keys:
+        return
+    keys = list(keys)
+    cache.delete_many(keys)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def document_page_keys(slug):
+    """Return cache keys of the HTML and RDF views of a document"""
+
+    return [page_key('fs_dokument', slug), page_key('fs_dokument_rdf', slug)]
+
+
+def feed_page_keys():
+    """Return cache keys of the Atom feed"""
+
+    return [page_key('atomfeed')]
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Delivery of uploaded files below '/dokument/'.
+
+Requests are authorized by the 'dokument' view, which then hands the
+file to the backend named by the 'FST_FILE_DELIVERY' setting:
+
+  * 'fst_web.fs_doc.delivery.serve_file' streams the file from Django,
+    with support for single byte ranges. Meant for development.
+  * 'fst_web.fs_doc.delivery.x_accel_redirect' lets nginx send the file
+    through an internal location (see 'deploy/nginx/nginx.conf'), so no
+    worker is tied up while the bytes are transferred.
+
+A backend is a function of request and 'StoredFile' returning a response.
+"""
+
+import mimetypes
+import os
+import re
+from collections import namedtuple
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, quote_etag, urlquote
+from django.utils.module_loading import import_string
+from fst_web.fs_doc.models import AllmannaRad, Bilaga, KonsolideradForeskrift
+from fst_web.fs_doc.models import Myndighetsforeskrift, OvrigtDokument
+
+# Uploaded file of a model: (model, file field, md5 field, lookup of the
+# publication flag of the document the file belongs to)
+FILE_FIELDS = (
+    (Myndighetsforeskrift, 'content', 'content_md5', 'is_published'),
+    (AllmannaRad, 'content', 'content_md5', 'is_published'),
+    (KonsolideradForeskrift, 'content', 'content_md5',
+     'grundforfattning__is_published'),
+    (Bilaga, 'file', 'file_md5', 'foreskrift__is_published'),
+    (OvrigtDokument, 'file', 'file_md5', 'foreskrift__is_published'),
+)
+
+StoredFile = namedtuple('StoredFile', 'name md5 is_published')
+
+# Number of bytes read at a time when streaming a file
+FILE_STREAM_CHUNK_SIZE = 64 * 1024
+
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def find_file(name):
+    """Return 'StoredFile' for uploaded file 'name', or None if unknown.
+
+    Only models with a matching 'upload_to' directory are searched, so a
+    lookup is normally a single query.
+    """
+
+    directory = name.split('/', 1)[0]
+    for model, file_field, md5_field, published_lookup in FILE_FIELDS:
+        if model._meta.get_field(file_field).upload_to != directory:
+            continue
+        row = model.objects.filter(**{file_field: name}).values_list(
+            md5_field, published_lookup).first()
+        if row:
+            return StoredFile(name, *row)
+    return None
+
+
+def content_type(name):
+    """Return Content-Type header value of file 'name'"""
+
+    mime_type, encoding = mimetypes.guess_type(name)
+    return mime_type or 'application/octet-stream'
+
+
+def file_path(stored):
+    """Return path of 'stored' in the file system"""
+
+    return os.path.join(settings.MEDIA_ROOT, stored.name)
+
+
+def byte_range(header, size):
+    """Return (first, last) byte position of the Range header 'header'.
+
+    Returns None when the whole file should be sent: no header, a header
+    that can not be parsed, or several ranges. Raises
+    'RangeNotSatisfiable' when the range is outside of the file.
+    """
+
+    match = BYTE_RANGE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+        if first > last:
+            if first >= size:
+                raise RangeNotSatisfiable
+            return None
+    else:
+        # Suffix range: the last bytes of the file
+        if int(last) == 0:
+            raise RangeNotSatisfiable
+        first, last = max(size - int(last), 0), size - 1
+    return first, last
+
+
+def read_chunks(f, first, length):
+    """Generate 'length' bytes of open file 'f' from position 'first'"""
+
+    try:
+        f.seek(first)
+        while length > 0:
+            data = f.read(min(FILE_STREAM_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def serve_file(request, stored):
+    """Stream the file from Django in 'FILE_STREAM_CHUNK_SIZE' chunks.
+
+    A single byte range is sent as 206 Partial Content, unless If-Range
+    names another version of the file.
+    """
+
+    try:
+        f = open(file_path(stored), 'rb')
+    except (IOError, OSError):
+        raise Http404
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
+    last_modified = http_date(stat.st_mtime)
+
+    header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range not in (
+            last_modified, quote_etag(stored.md5) if stored.md5 else None):
+        header = None
+    try:
+        requested = byte_range(header, size)
+    except RangeNotSatisfiable:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%s' % size
+        return response
+
+    first, last = requested or (0, size - 1)
+    response = StreamingHttpResponse(
+        read_chunks(f, first, last - first + 1),
+        content_type=content_type(stored.name))
+    if requested:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %s-%s/%s' % (first, last, size)
+    response['Content-Length'] = max(last - first + 1, 0)
+    response['Last-Modified'] = last_modified
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def x_accel_redirect(request, stored):
+    """Let nginx send the file from 'FST_FILE_DELIVERY_INTERNAL_URL'.
+
+    nginx keeps Content-Type from this response, computes Content-Length
+    and answers Range requests itself.
+    """
+
+    response = HttpResponse(content_type=content_type(stored.name))
+    response['X-Accel-Redirect'] = urlquote(
+        settings.FST_FILE_DELIVERY_INTERNAL_URL + stored.name)
+    return response
+
+
+def deliver(request, stored):
+    """Return response for 'stored' from the configured backend"""
+
+    return import_string(settings.FST_FILE_DELIVERY)(request, stored)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from fst_web.fs_doc.cache import feed_page_keys, invalidate_pages
+from fst_web.fs_doc.models import FeedArchive, freeze_feed_archives
+
+
+class Command(BaseCommand):
+    """
+    Freeze full pages of the Atom feed into archive pages.
+
+    Pages are frozen when Atom entries are written. Run this after
+    setting 'FST_FEED_PAGE_SIZE' on an existing instance, or after
+    loading entries directly into the database.
+    """
+    help = 'Freeze full pages of the Atom feed (FST_FEED_PAGE_SIZE)'
+
+    def handle(self, *args, **options):
+        if not settings.FST_FEED_PAGE_SIZE:
+            raise CommandError("FST_FEED_PAGE_SIZE is not set")
+        before = FeedArchive.objects.count()
+        archive = freeze_feed_archives()
+        frozen = FeedArchive.objects.count() - before
+        if frozen:
+            invalidate_pages(feed_page_keys())
+        self.stdout.write("Froze %s archive pages, latest is %s" % (
+            frozen, archive.number if archive else "none"))
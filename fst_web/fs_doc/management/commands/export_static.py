@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import HttpRequest
+from django.template import loader
+
+from fst_web.fs_doc.models import FeedArchive, RDFPost
+from fst_web.fs_doc.views import atomfeed, fs_dokument_template
+
+# File in the export directory listing exported files and their checksums
+MANIFEST = ".export_manifest.json"
+
+
+class Command(BaseCommand):
+    """
+    Export the public site as static files, to be served by nginx.
+
+    The Atom feed is written to 'feed/index.xml', its archive pages to
+    'feed/archive/<number>/index.xml', and for each document with an RDF
+    post the RDF to 'publ/<slug>/rdf' and the HTML page to
+    'publ/<slug>/index.html', as served by the public views. This
+    includes documents that are not published yet. A manifest of the
+    checksums of the exported files is kept in the directory, so later
+    exports only write what has changed and remove files of deleted
+    documents. The RDF of a document
+    is written when it has been published again, and its HTML page when
+    the rendered page differs from the exported one. See
+    'deploy/nginx/fst_static_export.conf'.
+    """
+    help = 'Export feed, RDF and HTML pages of documents as static files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory',
+                            help="Directory to export to")
+        parser.add_argument(
+            '--full', action='store_true',
+            help="Write all files, not only those changed since the last "
+                 "export")
+        parser.add_argument(
+            '--batch-size', type=int, default=200,
+            help="Number of documents read from the database together")
+
+    def handle(self, *args, **options):
+        self.directory = os.path.abspath(options['directory'])
+        self.counts = {'written': 0, 'unchanged': 0, 'removed': 0}
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        self.manifest = {}
+        if not options['full'] and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        exported = {}
+
+        # Documents. The RDF is only read when changed, while the HTML
+        # pages are all rendered, since they also show related objects
+        # that can change without the RDF, and compared by checksum.
+        post_ids = iter(RDFPost.objects.order_by('id').values_list(
+            'id', flat=True))
+        while True:
+            batch = list(islice(post_ids, options['batch_size']))
+            if not batch:
+                break
+            changed = {}
+            for rdf_post in RDFPost.objects.filter(id__in=batch).defer(
+                    'data').prefetch_related('content_object'):
+                rdf_path, html_path = self.document_paths(rdf_post.slug)
+                exported[rdf_path] = rdf_post.md5
+                if self.is_exported(rdf_path, rdf_post.md5):
+                    self.counts['unchanged'] += 1
+                else:
+                    changed[rdf_post.id] = (rdf_path, rdf_post.md5)
+                html = self.render_document(rdf_post)
+                if html is not None:
+                    md5 = hashlib.md5(html).hexdigest()
+                    exported[html_path] = md5
+                    self.export(html_path, html, md5)
+            for post_id, data in RDFPost.objects.filter(
+                    id__in=changed).values_list('id', 'data'):
+                rdf_path, md5 = changed[post_id]
+                self.export(rdf_path, data.encode('utf-8'), md5)
+
+        # Feed and frozen archive pages
+        request = HttpRequest()
+        request.method = 'GET'
+        response = atomfeed(request)
+        if response.streaming:
+            data = b"".join(response.streaming_content)
+        else:
+            data = response.content
+        md5 = hashlib.md5(data).hexdigest()
+        exported['feed/index.xml'] = md5
+        self.export('feed/index.xml', data, md5)
+        for number, md5 in FeedArchive.objects.values_list('number', 'md5'):
+            path = 'feed/archive/%s/index.xml' % number
+            exported[path] = md5
+            if not self.is_exported(path, md5):
+                archive = FeedArchive.objects.get(number=number)
+                self.export(path, archive.data.encode('utf-8'), md5)
+            else:
+                self.counts['unchanged'] += 1
+
+        for path in set(self.manifest) - set(exported):
+            self.remove(path)
+
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(exported, f, indent=0, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+        self.stdout.write(
+            "%(written)s files written, %(unchanged)s unchanged, "
+            "%(removed)s removed" % self.counts)
+
+    def document_paths(self, slug):
+        """Return paths of RDF and HTML page of document with 'slug'"""
+
+        return ('publ/%s/rdf' % slug, 'publ/%s/index.html' % slug)
+
+    def render_document(self, rdf_post):
+        """Return HTML page of document of 'rdf_post', or None"""
+
+        template = fs_dokument_template(rdf_post.content_object)
+        if not template:
+            return None
+        return loader.render_to_string(
+            template, dict(doc=rdf_post.content_object)).encode('utf-8')
+
+    def full_path(self, path):
+        full_path = os.path.normpath(os.path.join(self.directory, path))
+        if not full_path.startswith(self.directory + os.sep):
+            raise CommandError("%s is outside of the export directory" %
+                               path)
+        return full_path
+
+    def is_exported(self, path, md5):
+        """Return True if 'path' was exported with checksum 'md5'"""
+
+        return self.manifest.get(path) == md5 and \
+            os.path.exists(self.full_path(path))
+
+    def export(self, path, data, md5):
+        """Write 'data' to 'path', unless exported with 'md5' already"""
+
+        if self.is_exported(path, md5):
+            self.counts['unchanged'] += 1
+            return
+        full_path = self.full_path(path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        tmp_path = full_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, full_path)
+        self.counts['written'] += 1
+
+    def remove(self, path):
+        full_path = self.full_path(path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+            self.counts['removed'] += 1
+        try:
+            os.removedirs(os.path.dirname(full_path))
+        except OSError:
+            # Directory is not empty
+            pass
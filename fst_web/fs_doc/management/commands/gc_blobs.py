@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from fst_web.fs_doc.delivery import FILE_FIELDS
+from fst_web.fs_doc.models import BLOB_DIR, BLOB_LOCK, OverwritingStorage
+
+
+class Command(BaseCommand):
+    """
+    Remove stored blobs that no uploaded file refers to any longer.
+
+    With 'FST_FILE_BLOBS', every file name of a document is a hard link
+    to a blob named by its md5. A blob is unreferenced when no row in the
+    database has its md5, and is removed together with the file names
+    still linked to it. Blobs changed within '--min-age' minutes are kept,
+    as the row of a file being uploaded may not be committed yet.
+    """
+    help = 'Remove unreferenced blobs of uploaded files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="List unreferenced blobs without removing them")
+        parser.add_argument(
+            '--min-age', type=int, default=60,
+            help="Keep blobs changed within this many minutes")
+
+    def handle(self, *args, **options):
+        removed = size = 0
+        storage = OverwritingStorage()
+        blob_root = os.path.join(settings.MEDIA_ROOT, BLOB_DIR)
+        min_ctime = time.time() - options['min_age'] * 60
+        with storage.blob_lock(exclusive=True):
+            referenced = set()
+            for model, file_field, md5_field, published_lookup in \
+                    FILE_FIELDS:
+                referenced.update(
+                    model.objects.values_list(md5_field, flat=True))
+            unreferenced = {}
+            for directory, dirnames, filenames in os.walk(blob_root):
+                for filename in filenames:
+                    if filename == BLOB_LOCK or filename in referenced:
+                        continue
+                    path = os.path.join(directory, filename)
+                    stat = os.stat(path)
+                    if stat.st_ctime > min_ctime:
+                        continue
+                    unreferenced[(stat.st_dev, stat.st_ino)] = path
+                    removed += 1
+                    size += stat.st_size
+            paths = list(unreferenced.values())
+            if unreferenced:
+                paths.extend(self.find_links(blob_root, unreferenced))
+            for path in sorted(paths):
+                if options['dry_run']:
+                    self.stdout.write(path)
+                else:
+                    os.remove(path)
+        self.stdout.write("%s %s unreferenced blobs (%s bytes)" % (
+            "Found" if options['dry_run'] else "Removed", removed, size))
+
+    def find_links(self, blob_root, blobs):
+        """Return paths of uploaded files linked to 'blobs'"""
+
+        for directory, dirnames, filenames in os.walk(settings.MEDIA_ROOT):
+            dirnames[:] = [
+                dirname for dirname in dirnames
+                if os.path.join(directory, dirname) != blob_root]
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                stat = os.lstat(path)
+                if (stat.st_dev, stat.st_ino) in blobs:
+                    yield path
@@ -1,22 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import sys,os,re,shutil,hashlib,stat
+import json
+import socket
+import threading
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
 from pprint import pprint
 from collections import defaultdict
-from urllib import urlopen, urlretrieve
+from urllib.parse import urljoin, urlsplit
+from urllib.request import urlopen
 
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from rdflib import Graph, Literal, URIRef, Namespace, RDF
 import sqlite3
 
+from fst_web.fs_doc.bulkload import DuplicateRowsError, bulk_load
+from fst_web.fs_doc.titleindex import TitleIndex
 from fst_web.fs_doc.models import Myndighetsforeskrift, AllmannaRad, \
-    KonsolideradForeskrift, generate_rdf_post_for
+    KonsolideradForeskrift, generate_rdf_post_for, get_file_md5
 
 DCT = Namespace('http://purl.org/dc/terms/')
 RPUBL = Namespace('http://rinfo.lagrummet.se/ns/2008/11/rinfo/publ#')
 
+NS_ATOM = 'http://www.w3.org/2005/Atom'
+NS_ATOMLE = 'http://purl.org/atompub/link-extensions/1.0'
+
+# Stored identifiers of FSDokument, computed from the other fields
+CACHED_FIELDS = ('cached_identifierare', 'cached_slug', 'cached_rinfo_uri')
+
 # Normal dicts aren't hashable, and can thus not be keys in dicts
 # themselves. These dicts can (but modifying it will change the hash,
 # so don't do that)
@@ -24,10 +39,69 @@ class hashabledict(dict):
     def __hash__(self):
         return hash(tuple(sorted(self.items())))
 
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections, one per host and thread.
+
+    Connections are reused for all requests to the same host from the
+    same thread. A connection closed by the server is reopened once.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self, scheme, netloc):
+        connections = self.local.__dict__.setdefault('connections', {})
+        if (scheme, netloc) not in connections:
+            cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+            connections[(scheme, netloc)] = cls(netloc, timeout=self.timeout)
+        return connections[(scheme, netloc)]
+
+    def get(self, url, redirects=5):
+        """Return response for GET request. It must be read to the end."""
+        parts = urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        for attempt in (1, 2):
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                break
+            except (HTTPException, socket.error):
+                # Probably a kept-alive connection closed by the server
+                conn.close()
+                if attempt == 2:
+                    raise
+        if response.status in (301, 302, 303, 307, 308) and redirects:
+            response.read()
+            return self.get(urljoin(url, response.getheader('Location')),
+                            redirects - 1)
+        if response.status != 200:
+            response.read()
+            raise IOError("GET %s failed: %s %s" % (
+                url, response.status, response.reason))
+        return response
+
+    def download(self, url, path):
+        """Save content of URL as file and return its md5 checksum"""
+        response = self.get(url)
+        md5 = hashlib.md5()
+        with open(path + '.part', 'wb') as f:
+            for chunk in iter(lambda: response.read(64 * 1024), b''):
+                md5.update(chunk)
+                f.write(chunk)
+        os.replace(path + '.part', path)
+        return md5.hexdigest()
+
+
 class Command(BaseCommand):
-    args = '<feedurl>'
     help = 'Imports all entries (RDF+PDF) from a Atom feed'
 
+    # Where downloaded files and the checkpoint of completed entries are kept
+    download_dir = 'importfeed_downloads'
+    workers = 8
+
     # a dict of list of dicts, representing tables and their rows and the fields of those
     data = {'fs_doc_fsdokument':[],
             'fs_doc_myndighetsforeskrift':[],
@@ -47,43 +121,172 @@ class Command(BaseCommand):
     bemyndiganden = {}
     celex = {}
     titlar = {}
-    titlegraph = None
+    titleindex = None
+
+    # Indexes of rows in data, kept in step with the row lists.
+    # key: (forfattningssamling_id, arsutgava, lopnummer), value: id
+    fsdokument_ids = {}
+    # key: kortnamn, value: id
+    forfattningssamling_ids = {}
+    # key: namn, value: id
+    myndighet_ids = {}
     
     current_document = {}
     current_subdocument = {}
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        # Give each import its own rows and indexes
+        self.data = dict((table, []) for table in self.data)
+        self.bemyndiganden = {}
+        self.celex = {}
+        self.fsdokument_ids = {}
+        self.forfattningssamling_ids = {}
+        self.myndighet_ids = {}
+        self.current_document = {}
+        self.current_subdocument = {}
     
+    def add_arguments(self, parser):
+        parser.add_argument('feedurl', nargs='+')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='workers',
+            default=self.workers,
+            help='Number of concurrent downloads')
+        parser.add_argument(
+            '--download-dir',
+            dest='download_dir',
+            default=self.download_dir,
+            help='Directory for downloaded files and checkpoint. Entries '
+                 'already downloaded there are not fetched again.')
+
     def handle(self, *args, **options):
         db_path = settings.DATABASES['default']['NAME']
-        for url in args:
+        self.workers = options['workers']
+        self.download_dir = options['download_dir']
+        self.pool = ConnectionPool()
+        for url in options['feedurl']:
             self.stdout.write('Loading data from %s\n' % url)
             self.importfeed(url)
             self.load_db(db_path)
+            call_command('update_identifiers')
             self.generate_rdf_posts()
 
     def importfeed(self,url):
-        stream = urlopen(url)
-        tree = ET.parse(stream)
-        ns = 'http://www.w3.org/2005/Atom'
-        for entry in list(reversed(tree.findall('.//{%s}entry'%ns))):
-            pdf_url = None
-            rdf_url = None
+        entries = self.read_feed(url)
+        for record in self.fetch_entries(entries):
+            sys.stderr.write("RDF: %s\nPDF: %s\n" % (record['rdf_url'],
+                                                      record['pdf_url']))
+            self.add_entry(record['rdf_path'], record['pdf_path'],
+                           record['pdf_md5'])
+        #pprint(self.data)
+
+    def read_feed(self, url):
+        """Return entries of feed as dicts, oldest first"""
+        tree = ET.fromstring(self.pool.get(url).read())
+        entries = []
+        for entry in list(reversed(tree.findall('.//{%s}entry' % NS_ATOM))):
+            record = {'rdf_url': None,
+                      'pdf_url': None,
+                      'pdf_md5': None,
+                      'updated': entry.findtext('{%s}updated' % NS_ATOM)}
             for node in entry:
-                if (node.tag == "{%s}link"%ns and 
+                if (node.tag == "{%s}link" % NS_ATOM and
                     node.get('type') == 'application/rdf+xml'):
-                    rdf_url = node.get("href")
-                elif (node.tag == "{%s}content"%ns and 
+                    record['rdf_url'] = urljoin(url, node.get("href"))
+                elif (node.tag == "{%s}content" % NS_ATOM and
                       node.get('type') == 'application/pdf'):
-                    pdf_url = node.get("src")
-            sys.stderr.write("RDF: %s\nPDF: %s\n" % (rdf_url,pdf_url))
-            self.add_entry(rdf_url,pdf_url)
-        #pprint(self.data)
+                    record['pdf_url'] = urljoin(url, node.get("src"))
+                    record['pdf_md5'] = node.get('{%s}md5' % NS_ATOMLE)
+            entries.append(record)
+        return entries
+
+    def fetch_entries(self, entries):
+        """Download RDF and PDF for entries, several at a time.
 
-    def add_entry(self,rdf_url,pdf_url):
+        Completed entries are appended to a checkpoint file in the
+        download directory, so an interrupted import can be resumed.
+        Returns records with paths of downloaded files, in feed order.
+        """
+        if not os.path.exists(self.download_dir):
+            os.makedirs(self.download_dir)
+        checkpoint_path = os.path.join(self.download_dir, 'checkpoint.jsonl')
+        completed = {}
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        completed[record['rdf_url']] = record
+
+        results = [None] * len(entries)
+        pending = []
+        for i, entry in enumerate(entries):
+            record = completed.get(entry['rdf_url'])
+            if (record and record['updated'] == entry['updated'] and
+                    os.path.exists(record['rdf_path']) and
+                    (not record['pdf_path'] or
+                     os.path.exists(record['pdf_path']))):
+                results[i] = record
+            else:
+                pending.append(i)
+
+        failed = []
+        with open(checkpoint_path, 'a') as checkpoint, \
+                ThreadPoolExecutor(self.workers) as executor:
+            futures = dict((executor.submit(self.fetch_entry, entries[i]), i)
+                           for i in pending)
+            for future in as_completed(futures):
+                entry = entries[futures[future]]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    sys.stderr.write("Failed to fetch %s: %s\n" % (
+                        entry['rdf_url'], e))
+                    failed.append(entry)
+                    continue
+                results[futures[future]] = record
+                checkpoint.write(json.dumps(record) + "\n")
+                checkpoint.flush()
+        if failed:
+            raise CommandError(
+                "%s entries could not be fetched. Run again to resume."
+                % len(failed))
+        return results
+
+    def fetch_entry(self, entry):
+        """Download RDF and PDF of one entry to the download directory.
+
+        A PDF that is already downloaded is kept if its checksum matches
+        the one given in the feed.
+        """
+        base = os.path.join(
+            self.download_dir,
+            hashlib.sha1(entry['rdf_url'].encode('utf-8')).hexdigest())
+        record = dict(entry, rdf_path=base + '.rdf', pdf_path=None)
+        self.pool.download(entry['rdf_url'], record['rdf_path'])
+        if entry['pdf_url']:
+            record['pdf_path'] = base + '.pdf'
+            if not (entry['pdf_md5'] and
+                    os.path.exists(record['pdf_path']) and
+                    self.file_md5(record['pdf_path']) == entry['pdf_md5']):
+                record['pdf_md5'] = self.pool.download(entry['pdf_url'],
+                                                       record['pdf_path'])
+        return record
+
+    def file_md5(self, path):
+        with open(path, 'rb') as f:
+            return get_file_md5(f)
+
+    def add_entry(self, rdf_path, pdf_path, pdf_md5):
         g = Graph()
+        g.parse(rdf_path, format='xml')
+        self.add_graph(g, pdf_path, pdf_md5)
+
+    def add_graph(self, g, pdf_path, pdf_md5):
         g.bind('dct','http://purl.org/dc/terms/')
         g.bind('rpubl','http://rinfo.lagrummet.se/ns/2008/11/rinfo/publ#')
-        g.parse(urlopen(rdf_url))
-
         # first get type
         for (s,p,o) in g:
             if p == RDF.type:
@@ -136,20 +339,19 @@ class Command(BaseCommand):
         if not os.path.exists(targetdir):
             os.makedirs(targetdir)
         outfile = "%s/%s.pdf" % (targetdir,basefile)
-        urlretrieve(pdf_url,outfile)
+        shutil.copyfile(pdf_path, outfile)
         sub_d['content'] = outfile
-
-        md5 = hashlib.md5()
-        with open(outfile,'rb') as f: 
-            for chunk in iter(lambda: f.read(8192), ''): 
-                md5.update(chunk)
-        d['content_md5'] = md5.hexdigest()
+        d['content_md5'] = pdf_md5
 
         # Make sure all other fields have some sort of data
         if not 'sammanfattning' in d:
             d['sammanfattning'] = ""
         if not 'omtryck' in d:
             d['omtryck'] = '0'
+        if table == 'fs_doc_fsdokument':
+            # Filled in by update_identifiers after loading
+            for fld in CACHED_FIELDS:
+                d[fld] = ''
         if not 'beslutsdatum' in d:
             d['beslutsdatum'] = "%s-12-31"%d['arsutgava']
             sys.stderr.write("  WARNING: No beslutsdatum found, setting to %s\n"%d['beslutsdatum'])
@@ -176,6 +378,10 @@ class Command(BaseCommand):
         # appropriate place in data, and then clear them for
         # recycling
         self.data[table].append(d.copy())
+        if table == 'fs_doc_fsdokument':
+            self.fsdokument_ids.setdefault(
+                (d['forfattningssamling_id'], d['arsutgava'], d['lopnummer']),
+                d['id'])
         d.clear()
         if table=='fs_doc_fsdokument':
 
@@ -220,74 +426,58 @@ class Command(BaseCommand):
     def get_titel_from_sfsnr(self, sfsnr):
         if sfsnr in self.titlar:
             return self.titlar[sfsnr]
-        titlefile = "titles.n3"
-        url = "https://lagen.nu/sfs/parsed/rdf.nt"
-        if not os.path.exists(titlefile):
-        # TODO: 1: Download big n3 file from lagen.nu
-            sys.stderr.write("Downloading N3 file (will take a few minutes...)\n")
-            stream = urlopen(url)
-            nt = open(titlefile,"w")
-            for line in stream:
-        #       2: Save dct:title lines
-                if '<http://purl.org/dc/terms/title>' in line:
-                    nt.write(line)
-            nt.close()
-
-        #       3: lookup title
-        if not self.titlegraph:
-            sys.stderr.write("Loading title graph from %s\n" % titlefile)
-            self.titlegraph = Graph()
-            self.titlegraph.bind('dct','http://purl.org/dc/terms/')
-            self.titlegraph.bind('rpubl','http://rinfo.lagrummet.se/ns/2008/11/rinfo/publ#')
-            self.titlegraph.parse(titlefile, format="nt")
-
-        subj = URIRef("http://rinfo.lagrummet.se/publ/sfs/%s" % sfsnr)
-        pred = DCT['title']
-        titles = list(self.titlegraph.objects(subj,pred))
-        if titles:
-            title = titles[0]
-        else:
+        if not self.titleindex:
+            self.titleindex = self.get_titleindex()
+
+        title = self.titleindex.get(sfsnr)
+        if not title:
             # probably old 
             title = "SFS %s" % sfsnr
-        
-        #       4: save title in self.titlar so we can look for it later.
+
+        # save title in self.titlar so we can look for it later.
         self.titlar[sfsnr] = title
 
         return title
-    
+
+    def get_titleindex(self):
+        """Open index of SFS titles, building it the first time"""
+        indexfile = "titles.sqlite"
+        titlefile = "titles.n3"
+        url = "https://lagen.nu/sfs/parsed/rdf.nt"
+        if os.path.exists(indexfile):
+            return TitleIndex(indexfile)
+        if os.path.exists(titlefile):
+            # Saved by earlier versions of this command
+            sys.stderr.write("Building title index from %s\n" % titlefile)
+            with open(titlefile, "rb") as lines:
+                return TitleIndex.build(indexfile, lines)
+        sys.stderr.write("Downloading N3 file (will take a few minutes...)\n")
+        return TitleIndex.build(indexfile, urlopen(url))
+
     def get_or_create_forfattningssamling(self, kortnamn):
-        forfattningssamling_id = None
-        for d in self.data['fs_doc_forfattningssamling']:
-            if d['kortnamn'] == kortnamn:
-                forfattningssamling_id = d['id']
-                break
+        forfattningssamling_id = self.forfattningssamling_ids.get(kortnamn)
 
         if not forfattningssamling_id:
-            forfattningssamling_id = len(self.data['fs_doc_forfattningssamling'])+1
-            self.data['fs_doc_forfattningssamling'].append({'id':str(forfattningssamling_id),
+            forfattningssamling_id = str(len(self.data['fs_doc_forfattningssamling'])+1)
+            self.data['fs_doc_forfattningssamling'].append({'id':forfattningssamling_id,
                                                        # FIXME: Find out real name
                                                        'titel':u'%s författningssamling'%kortnamn,
                                                        'kortnamn':kortnamn,
                                                        'slug':kortnamn.lower()})
+            self.forfattningssamling_ids[kortnamn] = forfattningssamling_id
         return forfattningssamling_id
 
+    def get_or_create_myndighet(self, namn):
+        myndighet_id = self.myndighet_ids.get(namn)
+
+        if not myndighet_id:
+            myndighet_id = str(len(self.data['fs_doc_myndighet'])+1)
+            self.data['fs_doc_myndighet'].append({'id':myndighet_id,'namn':namn})
+            self.myndighet_ids[namn] = myndighet_id
+        return myndighet_id
+
     def get_or_create_fsdokument(self,fs_id,arsutgava,lopnummer):
-        fsdokument_id = None
-
-        for d in self.data['fs_doc_fsdokument']:
-            if not (('forfattningssamling_id' in d) and
-                    ('arsutgava' in d) and
-                    ('lopnummer' in d)):
-                # If these properties are missing, it's almost certainly
-                # the very doc we're trying to find andringar/upphavningar
-                # for
-                continue
-
-            if ((d['forfattningssamling_id'] == fs_id) and
-                (d['arsutgava'] == arsutgava) and
-                (d['lopnummer'] == lopnummer)):
-                fsdokument_id = d['id']
-                break
+        fsdokument_id = self.fsdokument_ids.get((fs_id, arsutgava, lopnummer))
 
         if not fsdokument_id:
             # +2 because the main document we're creating hasn't been added to data yet
@@ -304,7 +494,9 @@ class Command(BaseCommand):
                                       'utkom_fran_tryck':'%s-01-01' % arsutgava,
                                       'omtryck':'0',
                                       'sammanfattning':''}
+            placeholder_fsdokument.update(dict.fromkeys(CACHED_FIELDS, ''))
             self.data['fs_doc_fsdokument'].append(placeholder_fsdokument)
+            self.fsdokument_ids[(fs_id, arsutgava, lopnummer)] = str(fsdokument_id)
 
             # We can't really be sure this is a
             # fs_doc_myndighetsforeskrift (could be fs_doc_allmantrad),
@@ -345,7 +537,7 @@ class Command(BaseCommand):
     def dct_identifier(self,obj,doctype): pass
 
     def dct_title(self,obj, doctype):
-        self.current_document['titel'] = unicode(obj)
+        self.current_document['titel'] = str(obj)
 
     def rpubl_arsutgava(self,obj, doctype):
         self.current_document['arsutgava'] = str(obj)
@@ -365,32 +557,18 @@ class Command(BaseCommand):
     def rpubl_beslutadAv(self, obj, doctype):
         # 1. calculate myndighetsnamn
         namn = self.org_resource_to_namn(obj)
-        # 2. find id of myndighet
-        myndighet_id = None
-        for d in self.data['fs_doc_myndighet']:
-            if d['namn'] == namn:
-                myndighet_id = d['id']
-        # 3. add myndighet if not found
-        if not myndighet_id:
-            myndighet_id = len(self.data['fs_doc_myndighet'])+1
-            self.data['fs_doc_myndighet'].append({'id':str(myndighet_id),'namn':namn})
-        # 4. set id value
-        self.current_subdocument['beslutad_av_id'] = str(myndighet_id)
+        # 2. find or add myndighet
+        myndighet_id = self.get_or_create_myndighet(namn)
+        # 3. set id value
+        self.current_subdocument['beslutad_av_id'] = myndighet_id
 
     def dct_publisher(self, obj, doctype):
         # 1. calculate myndighetsnamn
         namn = self.org_resource_to_namn(obj)
-        # 2. find id of myndighet
-        myndighet_id = None
-        for d in self.data['fs_doc_myndighet']:
-            if d['namn'] == namn:
-                myndighet_id = d['id']
-        # 3. add myndighet if not found
-        if not myndighet_id:
-            myndighet_id = len(self.data['fs_doc_myndighet'])+1
-            self.data['fs_doc_myndighet'].append({'id':str(myndighet_id),'namn':namn})
-        # 4. set id value
-        self.current_subdocument['utgivare_id'] = str(myndighet_id)
+        # 2. find or add myndighet
+        myndighet_id = self.get_or_create_myndighet(namn)
+        # 3. set id value
+        self.current_subdocument['utgivare_id'] = myndighet_id
 
     def rpubl_forfattningssamling(self, obj, doctype):
         # 1. calculate kortnamn
@@ -471,55 +649,26 @@ class Command(BaseCommand):
         Django admin. We must verify all necessary related tables are created.
         """
         sys.stderr.write("copying fst_no_docs.db to %s\n" % db_path)
-        import shutil
         shutil.copy2("../tools/fst_no_docs.db", db_path)
         # Group and other should have write permission
         mode = os.stat(db_path)[stat.ST_MODE]
         os.chmod(db_path,mode|stat.S_IWGRP|stat.S_IWOTH)
         
         db_connection = sqlite3.connect(db_path)
-        db_connection.text_factory = str  # bugger 8-bit bytestrings
 
         sys.stderr.write("loaded indata, %s top-level keys\n" % len(self.data))
-        for table in self.data.keys():
-            self.fill_table(table,self.data,db_connection)
-
-    def get_insert_string(self,row):
-        """ Build SQL string for fieldnames and values.
+        try:
+            violations = bulk_load(
+                db_connection, self.data, defer_checks=True,
+                log=lambda msg: sys.stderr.write(msg + "\n"))
+        except DuplicateRowsError as e:
+            db_connection.close()
+            raise CommandError("Could not load %s. %s" % (db_path, e))
+        for table, rowid, parent in violations:
+            sys.stderr.write("  WARNING: %s row %s refers to missing %s\n"
+                             % (table, rowid, parent))
+        db_connection.close()
 
-        Parameter 'row' is a dictionary, so we must keep key/value combinations
-        together when constructing the string.
-        """
-        fields = "("
-        values = " VALUES("
-        for key, val in row.items():
-            fields = fields + key + ", "
-            if type(val) == int:
-                val = str(val)
-            values = values + "'" + val + "'" + ", "
-        fields = fields[:-2] + ")"
-        values = values[:-2] + ")"
-        return fields + values
-
-
-    def fill_table(self,table_name, data, db_connection):
-        """Insert records in SQlite using a list of dictionaries """
-        sys.stderr.write("Filling table %s\n" % table_name)
-        for row in data[table_name]:
-            # print "   record"
-            self.fill_record(table_name, row, db_connection)
-
-
-    def fill_record(self,table_name, row, db_connection):
-        """Insert record in SQlite using a Python dictionary """
-        cursor = db_connection.cursor()
-        insert_statement = "INSERT INTO %s " % table_name
-        insert_data = self.get_insert_string(row)
-        sql = insert_statement + insert_data
-        # print sql
-        cursor.execute(sql)
-        db_connection.commit()
-        
     def generate_rdf_posts(self):
         for cls in (Myndighetsforeskrift, AllmannaRad, KonsolideradForeskrift):
             for obj in cls.objects.all():
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fst_web.fs_doc.cache import feed_page_keys, invalidate_pages
+from fst_web.fs_doc.models import AtomEntry, prefetch_entry_documents
+
+
+class Command(BaseCommand):
+    """
+    Render the stored XML of all Atom entries again.
+
+    Run this after changing 'foreskrift_entry.xml' or settings used by it,
+    since the feed is built from the stored fragments.
+    """
+    help = 'Rebuild stored XML fragments of all Atom entries'
+
+    def handle(self, *args, **options):
+        count = 0
+        with transaction.atomic():
+            for entry in prefetch_entry_documents(AtomEntry.objects.all()):
+                entry_xml = entry.render_entryxml()
+                if entry_xml != entry.entry_xml:
+                    AtomEntry.objects.filter(pk=entry.pk).update(
+                        entry_xml=entry_xml, xml_changed=datetime.utcnow())
+                count += 1
+            invalidate_pages(feed_page_keys())
+        self.stdout.write("Rebuilt %s Atom entries" % count)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import multiprocessing
+from datetime import datetime
+from itertools import islice
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from fst_web.fs_doc.cache import document_page_keys, invalidate_pages
+from fst_web.fs_doc.models import AllmannaRad, AtomEntry, \
+    KonsolideradForeskrift, Myndighetsforeskrift, RDFPost, \
+    generate_atom_entry_for
+
+DOCUMENT_MODELS = (Myndighetsforeskrift, AllmannaRad, KonsolideradForeskrift)
+
+
+def serialize_documents(chunk):
+    """Return (id, slug, data, md5) for documents of one type.
+
+    Runs in a worker process. Related objects used by the RDF
+    descriptions are loaded in bulk for the whole chunk.
+    """
+
+    model_label, ids = chunk
+    model = apps.get_model(model_label)
+    queryset = model.objects.filter(id__in=ids)
+    if issubclass(model, KonsolideradForeskrift):
+        queryset = queryset.select_related(
+            'grundforfattning__forfattningssamling',
+            'senaste_andringsforfattning')
+    else:
+        queryset = queryset.select_related(
+            'forfattningssamling').prefetch_related(
+            'andringar__forfattningssamling',
+            'upphavningar__forfattningssamling',
+            'amnesord', 'bilagor', 'ovriga_dokument')
+        if issubclass(model, Myndighetsforeskrift):
+            queryset = queryset.prefetch_related(
+                'celexreferenser', 'bemyndiganden')
+    result = []
+    for obj in queryset:
+        data = obj.to_rdfxml()
+        result.append((obj.id, obj.get_fs_dokument_slug(), data,
+                       hashlib.md5(data.encode('utf-8')).hexdigest()))
+    return model_label, result
+
+
+class Command(BaseCommand):
+    """
+    Regenerate stored RDF metadata ('RDFPost') for documents.
+
+    Document ids are read in batches and serialized by a pool of worker
+    processes. Results are written back one batch per transaction, and
+    documents whose RDF is unchanged are not written at all. Atom entries
+    of changed documents are updated so that harvesters pick up the change.
+    """
+    help = 'Regenerate RDF metadata for documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            dest='since',
+            help='Only documents with an Atom entry updated on or after '
+                 'this date (YYYY-MM-DD)')
+        parser.add_argument(
+            '--collection',
+            dest='collection',
+            help='Only documents in this document collection (slug, '
+                 'e.g. exfs)')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Report what would change without writing anything')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='workers',
+            default=multiprocessing.cpu_count(),
+            help='Number of worker processes (1 runs in this process)')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=200,
+            help='Number of documents serialized and written together')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--since must be a date as YYYY-MM-DD")
+
+        # Ids are read before any worker is started, since the pool
+        # consumes its input from another thread
+        chunks = list(self.get_chunks(since, options['collection'],
+                                      options['batch_size']))
+        counts = {'total': 0, 'changed': 0}
+        if options['workers'] > 1:
+            # Workers must open their own database connections
+            connections.close_all()
+            pool = multiprocessing.Pool(options['workers'])
+            try:
+                for model_label, result in pool.imap(serialize_documents,
+                                                     chunks):
+                    self.write_batch(model_label, result, counts,
+                                     options['dry_run'])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in chunks:
+                model_label, result = serialize_documents(chunk)
+                self.write_batch(model_label, result, counts,
+                                 options['dry_run'])
+
+        self.stdout.write("%s documents, %s %s, %s unchanged" % (
+            counts['total'], counts['changed'],
+            "would be updated" if options['dry_run'] else "updated",
+            counts['total'] - counts['changed']))
+
+    def get_chunks(self, since, collection, batch_size):
+        """Generate (model label, ids) for documents to regenerate"""
+
+        for model in DOCUMENT_MODELS:
+            queryset = model.objects.all()
+            if collection:
+                if issubclass(model, KonsolideradForeskrift):
+                    queryset = queryset.filter(
+                        grundforfattning__forfattningssamling__slug=collection)
+                else:
+                    queryset = queryset.filter(
+                        forfattningssamling__slug=collection)
+            if since:
+                queryset = queryset.filter(id__in=AtomEntry.objects.filter(
+                    content_type=ContentType.objects.get_for_model(model),
+                    updated__gte=since).values('object_id'))
+            ids = queryset.order_by('id').values_list(
+                'id', flat=True).iterator()
+            while True:
+                batch = list(islice(ids, batch_size))
+                if not batch:
+                    break
+                yield model._meta.label, batch
+
+    def write_batch(self, model_label, result, counts, dry_run):
+        """Store RDF that differs from what is already stored"""
+
+        model = apps.get_model(model_label)
+        content_type = ContentType.objects.get_for_model(model)
+        existing = dict(
+            (object_id, (pk, md5, slug)) for pk, object_id, md5, slug in
+            RDFPost.objects.filter(
+                content_type=content_type,
+                object_id__in=[row[0] for row in result]).values_list(
+                'id', 'object_id', 'md5', 'slug'))
+        changed = [row for row in result
+                   if existing.get(row[0], (None, None, None))[1] != row[3]]
+        counts['total'] += len(result)
+        counts['changed'] += len(changed)
+        if dry_run or not changed:
+            return
+
+        with transaction.atomic():
+            new_posts = []
+            keys = []
+            for object_id, slug, data, md5 in changed:
+                keys.extend(document_page_keys(slug))
+                if object_id in existing:
+                    keys.extend(document_page_keys(existing[object_id][2]))
+                    RDFPost.objects.filter(pk=existing[object_id][0]).update(
+                        slug=slug, data=data, md5=md5)
+                else:
+                    new_posts.append(RDFPost(
+                        content_type=content_type, object_id=object_id,
+                        slug=slug, data=data, md5=md5))
+            RDFPost.objects.bulk_create(new_posts)
+            invalidate_pages(keys)
+            for obj in model.objects.filter(
+                    id__in=[row[0] for row in changed]):
+                generate_atom_entry_for(obj, update_only=True)
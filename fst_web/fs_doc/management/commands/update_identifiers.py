@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fst_web.fs_doc.models import FSDokument, Forfattningssamling
+
+
+class Command(BaseCommand):
+    """
+    Fill in the stored identifier, slug and URI of all documents.
+
+    Run this after loading fixtures or importing rows directly into the
+    database, since the stored values are otherwise only set on save.
+    """
+    help = 'Update stored identifiers of all documents'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            for forfattningssamling in Forfattningssamling.objects.all():
+                forfattningssamling.update_cached_identifiers()
+        self.stdout.write("Updated identifiers of %s documents" %
+                          FSDokument.objects.count())
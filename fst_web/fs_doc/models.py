@@ -5,6 +5,8 @@
 import hashlib
 import os
 import tempfile
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from django.conf import settings
 from django.core import urlresolvers
@@ -15,14 +17,24 @@ from django.core.files.storage import FileSystemStorage
 from django.core.validators import RegexValidator
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
-from django.db import models
-from django.db.models.signals import post_delete
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Cast, Concat
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
 from django.template import loader
 from django.utils.feedgenerator import rfc3339_date
+from django.utils.safestring import mark_safe
 from fst_web.fs_doc import rdfviews
+from fst_web.fs_doc.cache import document_page_keys, feed_page_keys
+from fst_web.fs_doc.cache import invalidate_pages, page_cache
+from fst_web.fs_doc.uploadhandlers import has_checksums, new_checksums
 
 RINFO_PUBL_BASE = "http://rinfo.lagrummet.se/publ/"
 
+# Directory below MEDIA_ROOT of files stored by checksum
+BLOB_DIR = "blobs"
+# Lock file below BLOB_DIR, see 'OverwritingStorage.blob_lock'
+BLOB_LOCK = ".lock"
+
 
 class OverwritingStorage(FileSystemStorage):
     """ File storage that allows overwriting of stored files.
@@ -38,7 +50,15 @@ class OverwritingStorage(FileSystemStorage):
     def _save(self, name, content):
         """
         Lifted partially from django/core/files/storage.py
+
+        Checksums of the file are computed from the chunks as they are
+        written, and set as 'md5' (and 'sha256' if 'FST_FILE_SHA256' is
+        set) on 'content', unless the upload handlers in
+        'uploadhandlers.py' set them already. With 'FST_FILE_BLOBS', the
+        file is stored once per md5 below 'blobs' and 'name' is a hard
+        link to it.
         """
+        hashes = [] if has_checksums(content) else new_checksums()
         full_path = self.path(name)
         directory = os.path.dirname(full_path)
         if not os.path.exists(directory):
@@ -49,6 +69,10 @@ class OverwritingStorage(FileSystemStorage):
         # This file has a file path that we can move.
         if hasattr(content, 'temporary_file_path'):
             temp_data_location = content.temporary_file_path()
+            if hashes:
+                for chunk in content.chunks():
+                    for algorithm, checksum in hashes:
+                        checksum.update(chunk)
         else:
             tmp_prefix = "tmp_%s" % (get_valid_filename(name), )
             temp_data_location = tempfile.mktemp(
@@ -62,6 +86,8 @@ class OverwritingStorage(FileSystemStorage):
                              os.O_EXCL | getattr(os, 'O_BINARY', 0))
                 locks.lock(fd, locks.LOCK_EX)
                 for chunk in content.chunks():
+                    for algorithm, checksum in hashes:
+                        checksum.update(chunk)
                     os.write(fd, chunk)
                 locks.unlock(fd)
                 os.close(fd)
@@ -69,12 +95,98 @@ class OverwritingStorage(FileSystemStorage):
                 if os.path.exists(temp_data_location):
                     os.remove(temp_data_location)
                 raise e
-        file_move_safe(temp_data_location, full_path, allow_overwrite=True)
+        for algorithm, checksum in hashes:
+            setattr(content, algorithm, checksum.hexdigest())
+        if settings.FST_FILE_BLOBS:
+            self._link_blob(temp_data_location, full_path, content.md5,
+                            hasattr(content, 'temporary_file_path'))
+        else:
+            file_move_safe(temp_data_location, full_path,
+                           allow_overwrite=True)
         content.close()
         if settings.FILE_UPLOAD_PERMISSIONS is not None:
             os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
         return name
 
+    def blob_path(self, md5):
+        """Return path of the stored blob with checksum 'md5'"""
+
+        return self.path(os.path.join(BLOB_DIR, md5[:2], md5))
+
+    @contextmanager
+    def blob_lock(self, exclusive=False):
+        """Hold the lock of the blobs while in the block.
+
+        Files are linked to blobs holding the lock shared, and 'gc_blobs'
+        removes blobs holding it exclusively, so a blob is not removed
+        while being linked.
+        """
+        lock_path = self.path(os.path.join(BLOB_DIR, BLOB_LOCK))
+        if not os.path.exists(os.path.dirname(lock_path)):
+            os.makedirs(os.path.dirname(lock_path))
+        with open(lock_path, 'ab') as lock_file:
+            locks.lock(lock_file,
+                       locks.LOCK_EX if exclusive else locks.LOCK_SH)
+            try:
+                yield
+            finally:
+                locks.unlock(lock_file)
+
+    def _link_blob(self, temp_data_location, full_path, md5, uploaded):
+        """Store file as blob, unless stored already, and link 'full_path'.
+
+        The link is created beside 'full_path' and renamed, so the file is
+        replaced atomically.
+        """
+        blob_path = self.blob_path(md5)
+        tmp_link = tempfile.mktemp(prefix="tmp_link_",
+                                   dir=os.path.dirname(full_path))
+        with self.blob_lock():
+            try:
+                os.link(blob_path, tmp_link)
+            except FileNotFoundError:
+                if not os.path.exists(os.path.dirname(blob_path)):
+                    os.makedirs(os.path.dirname(blob_path))
+                file_move_safe(temp_data_location, blob_path,
+                               allow_overwrite=True)
+                os.link(blob_path, tmp_link)
+            else:
+                if not uploaded:
+                    os.remove(temp_data_location)
+        os.replace(tmp_link, full_path)
+
+
+def commit_file(instance, field_name, md5_field_name):
+    """Store a newly assigned file of 'instance' and set its md5.
+
+    Call before saving 'instance'. The checksum is taken from the storage
+    when it computes one while writing, so the file is not read again.
+    The storage overwrites files of the same name, which is only done for
+    the file of 'instance' itself. A name that another row refers to is
+    made unique, so that row keeps its file and md5.
+    """
+
+    field_file = getattr(instance, field_name, None)
+    if field_file is None:
+        return
+    if not field_file:
+        setattr(instance, md5_field_name, "")
+    elif not field_file._committed:
+        content = field_file.file
+        name = field_file.field.generate_filename(instance, field_file.name)
+        if type(instance)._default_manager.filter(
+                **{field_name: name}).exclude(pk=instance.pk).exists():
+            name = FileSystemStorage.get_available_name(
+                field_file.storage, name,
+                max_length=field_file.field.max_length)
+        field_file.save(os.path.basename(name), content, save=False)
+        md5 = getattr(content, 'md5', None)
+        if not md5:
+            with getattr(instance, field_name).storage.open(
+                    getattr(instance, field_name).name) as stored:
+                md5 = get_file_md5(stored)
+        setattr(instance, md5_field_name, md5)
+
 
 class Document(models.Model):
 
@@ -101,16 +213,18 @@ def current_year():
     return datetime.now().year
 
 
-def next_lopnummer():
-    docs = FSDokument.objects.filter(arsutgava = current_year())
-    numbers = []
-    for doc in docs:
-        numbers.append(int(doc.lopnummer))
-    if numbers:
-        next_nr = max(numbers) + 1
-    else:
-        next_nr = 1
-    return next_nr
+def next_lopnummer(arsutgava=None, forfattningssamling=None):
+    """Return next 'lopnummer' in a year, by default the current one.
+
+    Optionally only documents in 'forfattningssamling' are counted.
+    """
+
+    docs = FSDokument.objects.filter(arsutgava=arsutgava or current_year())
+    if forfattningssamling:
+        docs = docs.filter(forfattningssamling=forfattningssamling)
+    latest = docs.aggregate(
+        latest=models.Max(Cast('lopnummer', models.IntegerField())))['latest']
+    return (latest or 0) + 1
 
 
 class FSDokument(Document):
@@ -131,7 +245,6 @@ class FSDokument(Document):
         "Löpnummer",
         max_length=3,
         unique=False,
-        default= next_lopnummer,
         validators=[RegexValidator(
             regex="^\d+$",
             message=u"Löpnummer får bara innehålla siffror")])
@@ -177,12 +290,60 @@ class FSDokument(Document):
     content_md5 = models.CharField(max_length=32,
                                    blank=True)
 
+    # Stored values of 'identifierare', 'get_fs_dokument_slug' and
+    # 'get_rinfo_uri', so that they can be read without a join
+    cached_identifierare = models.CharField(max_length=64,
+                                            blank=True,
+                                            editable=False,
+                                            db_index=True)
+
+    cached_slug = models.CharField(max_length=64,
+                                   blank=True,
+                                   editable=False,
+                                   db_index=True)
+
+    cached_rinfo_uri = models.CharField(max_length=255,
+                                        blank=True,
+                                        editable=False,
+                                        db_index=True)
+
+    class Meta:
+        # Two documents in a collection can't have the same number
+        unique_together = ('forfattningssamling', 'arsutgava', 'lopnummer')
+
     def __str__(self):
         """Display value for user interface."""
         return u'%s %s' % (self.identifierare, self.titel)
 
+    def save(self, *args, **kwargs):
+        # The file field is defined by subclasses
+        commit_file(self, 'content', 'content_md5')
+        self.update_cached_identifiers()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | set(
+                ('content_md5', 'cached_identifierare', 'cached_slug',
+                 'cached_rinfo_uri'))
+        super(FSDokument, self).save(*args, **kwargs)
+
+    def update_cached_identifiers(self):
+        self.cached_identifierare = "%s %s:%s" % (
+            self.forfattningssamling.kortnamn, self.arsutgava, self.lopnummer)
+        self.cached_slug = "%s/%s:%s" % (
+            self.forfattningssamling.slug, self.arsutgava, self.lopnummer)
+        self.cached_rinfo_uri = RINFO_PUBL_BASE + self.cached_slug
+
+    def _use_cached(self, value):
+        """Stored values are used unless missing, or the collection is
+        already loaded and can be used without a query"""
+
+        return value and not hasattr(
+            self, FSDokument.forfattningssamling.cache_name)
+
     @property
     def identifierare(self):
+        if self._use_cached(self.cached_identifierare):
+            return self.cached_identifierare
         return "%s %s:%s" % (self.forfattningssamling.kortnamn,
                              self.arsutgava, self.lopnummer)
 
@@ -202,10 +363,17 @@ class FSDokument(Document):
         return edit_url
 
     def get_fs_dokument_slug(self):
+        if self._use_cached(self.cached_slug):
+            return self.cached_slug
         return "%s/%s:%s" % (self.forfattningssamling.slug,
                              self.arsutgava,
                              self.lopnummer)
 
+    def get_rinfo_uri(self):
+        if self._use_cached(self.cached_rinfo_uri):
+            return self.cached_rinfo_uri
+        return super(FSDokument, self).get_rinfo_uri()
+
     def ikrafttradandear(self):
         """Support additional sorting: by year only"""
         return self.ikrafttradandedatum.year
@@ -266,16 +434,25 @@ class AllmannaRad(FSDokument):
         """
 
         label = u"Grundförfattning"
-        if (self.andringar.select_related().count() > 0):
+        # Admin changelists annotate the count to avoid a query per row
+        andringar_count = getattr(self, 'andringar_count', None)
+        if andringar_count is None:
+            andringar_count = self.andringar.count()
+        if andringar_count > 0:
             label = u"Ändringsförfattning"
         if self.omtryck:
             label += " (omtryck)"
         return label
     role_label.short_description = u"Roll"
+    role_label.admin_order_field = 'andringar_count'
+
+    def rdf_description(self):
+        """Return description of metadata for this document."""
+        return rdfviews.AllmanaRadDescription(self)
 
     def to_rdfxml(self):
         """Return metadata as RDF/XML for this document."""
-        return rdfviews.AllmanaRadDescription(self).to_rdfxml()
+        return self.rdf_description().to_rdfxml()
 
 
 class Myndighetsforeskrift(FSDokument):
@@ -344,17 +521,26 @@ class Myndighetsforeskrift(FSDokument):
         """
 
         label = u"Grundförfattning"
-        if (self.andringar.select_related().count() > 0):
+        # Admin changelists annotate the count to avoid a query per row
+        andringar_count = getattr(self, 'andringar_count', None)
+        if andringar_count is None:
+            andringar_count = self.andringar.count()
+        if andringar_count > 0:
             label = u"Ändringsförfattning"
         if self.omtryck:
             label += " (omtryck)"
         return label
 
     role_label.short_description = u"Roll"
+    role_label.admin_order_field = 'andringar_count'
+
+    def rdf_description(self):
+        """Return description of metadata for this document."""
+        return rdfviews.MyndighetsforeskriftDescription(self)
 
     def to_rdfxml(self):
         """Return metadata as RDF/XML for this document."""
-        return rdfviews.MyndighetsforeskriftDescription(self).to_rdfxml()
+        return self.rdf_description().to_rdfxml()
 
 
 class Myndighet(models.Model):
@@ -410,6 +596,49 @@ class Forfattningssamling(models.Model):
     def __str__(self):
         return u'%s %s' % (self.titel, self.kortnamn)
 
+    def save(self, *args, **kwargs):
+        super(Forfattningssamling, self).save(*args, **kwargs)
+        self.update_cached_identifiers()
+
+    def update_cached_identifiers(self):
+        """Update stored identifiers of all documents in the collection.
+
+        RDF posts and Atom entries of the documents, and of consolidations
+        of them, show the identifiers and are generated again. Cached
+        pages of the documents, by their old and new slugs, are removed.
+        """
+
+        content_types = ContentType.objects.get_for_models(
+            Myndighetsforeskrift, AllmannaRad, KonsolideradForeskrift)
+        number = Concat('arsutgava', models.Value(':'), 'lopnummer')
+        with transaction.atomic():
+            FSDokument.objects.filter(forfattningssamling=self).update(
+                cached_identifierare=Concat(
+                    models.Value(self.kortnamn + " "), number,
+                    output_field=models.CharField()),
+                cached_slug=Concat(
+                    models.Value(self.slug + "/"), number,
+                    output_field=models.CharField()),
+                cached_rinfo_uri=Concat(
+                    models.Value(RINFO_PUBL_BASE + self.slug + "/"), number,
+                    output_field=models.CharField()))
+
+            # Pages are found by the slug of the RDF post, so documents
+            # without one have no pages to update
+            for model, queryset in (
+                    (Myndighetsforeskrift,
+                     Myndighetsforeskrift.objects.filter(
+                         forfattningssamling=self)),
+                    (AllmannaRad, AllmannaRad.objects.filter(
+                        forfattningssamling=self)),
+                    (KonsolideradForeskrift,
+                     KonsolideradForeskrift.objects.filter(
+                         grundforfattning__forfattningssamling=self))):
+                update_documents(queryset.filter(
+                    id__in=RDFPost.objects.filter(
+                        content_type=content_types[model]).values(
+                        'object_id')))
+
     def get_rinfo_uri(self):
         """"Create URI for this document collection
 
@@ -441,6 +670,10 @@ class HasFile(models.Model):
     def __str__(self):
         return u'%s' % (self.titel)
 
+    def save(self, *args, **kwargs):
+        commit_file(self, 'file', 'file_md5')
+        super(HasFile, self).save(*args, **kwargs)
+
 
 class Bilaga(HasFile):
     foreskrift = models.ForeignKey('FSDokument',
@@ -589,6 +822,10 @@ class KonsolideradForeskrift(Document):
         """Display value for user interface."""
         return u'%s %s' % (self.identifierare, self.titel)
 
+    def save(self, *args, **kwargs):
+        commit_file(self, 'content', 'content_md5')
+        super(KonsolideradForeskrift, self).save(*args, **kwargs)
+
     def get_fs_dokument_slug(self):
         return "%s/konsolidering/%s" % (
             self.grundforfattning.get_fs_dokument_slug(),
@@ -614,9 +851,13 @@ class KonsolideradForeskrift(Document):
         """
         label = u"Konsoliderad författning"
 
+    def rdf_description(self):
+        """Return description of metadata for this document."""
+        return rdfviews.KonsolideradForeskriftDescription(self)
+
     def to_rdfxml(self):
         """Return metadata as RDF/XML for this document."""
-        return rdfviews.KonsolideradForeskriftDescription(self).to_rdfxml()
+        return self.rdf_description().to_rdfxml()
 
 
 class Bemyndigandereferens(models.Model):
@@ -660,13 +901,44 @@ class Bemyndigandereferens(models.Model):
 
 
 class GenericUniqueMixin(object):
+    """Lookup of the single instance for a document.
+
+    Subclasses must be unique on ('content_type', 'object_id'). Content
+    types are read from the cache of 'ContentType.objects'.
+    """
 
     @classmethod
     def get_for(cls, obj):
-        obj_type = ContentType.objects.get_for_model(obj)
-        for instance in cls.objects.filter(content_type__pk=obj_type.id,
-                                           object_id=obj.id):
-            return instance
+        return cls.filter_for([obj]).first()
+
+    @classmethod
+    def filter_for(cls, objs):
+        """Return queryset of instances for any of 'objs'"""
+
+        ids_by_type = defaultdict(list)
+        for obj in objs:
+            obj_type = ContentType.objects.get_for_model(obj)
+            ids_by_type[obj_type.id].append(obj.id)
+        if not ids_by_type:
+            return cls.objects.none()
+        condition = models.Q()
+        for content_type_id, ids in ids_by_type.items():
+            condition |= models.Q(content_type_id=content_type_id,
+                                  object_id__in=ids)
+        return cls.objects.filter(condition)
+
+    @classmethod
+    def get_for_objects(cls, objs):
+        """Return dict of instance by object for those of 'objs' that have
+        one, in one query"""
+
+        objs = list(objs)
+        by_key = dict(
+            ((ContentType.objects.get_for_model(obj).id, obj.id), obj)
+            for obj in objs)
+        return dict(
+            (by_key[(instance.content_type_id, instance.object_id)], instance)
+            for instance in cls.filter_for(objs))
 
     @classmethod
     def get_or_create(cls, obj):
@@ -688,7 +960,7 @@ class RDFPost(models.Model, GenericUniqueMixin):
         verbose_name_plural = u"Metadata"
 
     def save(self, *args, **kwargs):
-        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.md5 = hashlib.md5(self.data.encode('utf-8')).hexdigest()
         super(RDFPost, self).save(*args, **kwargs)
 
     @property
@@ -717,13 +989,33 @@ class AtomEntry(models.Model, GenericUniqueMixin):
 
     rdf_post = models.OneToOneField(RDFPost, null=True, blank=True)
 
+    # Rendered XML of this entry, see 'generate_atom_entry_for'
+    entry_xml = models.TextField(blank=True)
+
+    # Time the feed content of this entry last changed, also when
+    # 'entry_xml' is rebuilt without changing 'updated'. Used in the ETag
+    # of the feed.
+    xml_changed = models.DateTimeField(null=True, blank=True,
+                                       editable=False)
+
     class Meta:
+        unique_together = ('content_type', 'object_id')
         verbose_name = u"Flödespost"
         verbose_name_plural = u"Poster i ATOM-flödet"
 
     def to_entryxml(self):
         """XML representation of entry according to Atom standard.
 
+        Returns the stored fragment, or renders it for entries created
+        before fragments were stored.
+        """
+        if self.entry_xml:
+            return mark_safe(self.entry_xml)
+        return self.render_entryxml()
+
+    def render_entryxml(self):
+        """Render XML representation of entry.
+
         Uses template in templates/foreskrift_entry.xml
         """
         if not self.content_object:
@@ -744,15 +1036,244 @@ class AtomEntry(models.Model, GenericUniqueMixin):
         return template.render(context)
 
 
+def prefetch_entry_documents(entries):
+    """Load documents and related objects of Atom entries in bulk.
+
+    Documents are fetched with one query per content type, together with
+    their document collection, attachments and other documents. RDF posts
+    are fetched with one query. The objects are cached on each entry, so
+    rendering the entries needs no further queries.
+    """
+
+    entries = list(entries)
+    ids_by_type = defaultdict(set)
+    for entry in entries:
+        ids_by_type[entry.content_type_id].add(entry.object_id)
+
+    docs = {}
+    for content_type_id, ids in ids_by_type.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        queryset = model.objects.filter(id__in=ids)
+        if issubclass(model, FSDokument):
+            queryset = queryset.select_related(
+                'forfattningssamling').prefetch_related(
+                'bilagor', 'ovriga_dokument')
+        elif issubclass(model, KonsolideradForeskrift):
+            queryset = queryset.select_related(
+                'grundforfattning__forfattningssamling')
+        for doc in queryset:
+            docs[(content_type_id, doc.id)] = doc
+
+    rdf_post_ids = [entry.rdf_post_id for entry in entries
+                    if entry.rdf_post_id]
+    rdf_posts = RDFPost.objects.in_bulk(rdf_post_ids) if rdf_post_ids else {}
+
+    for entry in entries:
+        doc = docs.get((entry.content_type_id, entry.object_id))
+        if doc is not None:
+            setattr(entry, AtomEntry.content_object.cache_attr, doc)
+        if entry.rdf_post_id:
+            entry.rdf_post = rdf_posts.get(entry.rdf_post_id)
+    return entries
+
+
+def prefetch_documents(objs):
+    """Load related objects of documents of one type in bulk.
+
+    All relations shown in the RDF and in the Atom entry of the documents
+    are fetched with one query each, so rendering them needs no further
+    queries. Returns the documents as a list.
+    """
+
+    objs = list(objs)
+    if not objs:
+        return objs
+    model = type(objs[0])
+    if issubclass(model, FSDokument):
+        lookups = ['forfattningssamling', 'amnesord', 'bilagor',
+                   'ovriga_dokument', 'andringar__forfattningssamling',
+                   'upphavningar__forfattningssamling']
+        if issubclass(model, Myndighetsforeskrift):
+            lookups.extend(['celexreferenser', 'bemyndiganden'])
+    elif issubclass(model, KonsolideradForeskrift):
+        lookups = ['grundforfattning__forfattningssamling',
+                   'senaste_andringsforfattning']
+    else:
+        lookups = []
+    models.prefetch_related_objects(objs, *lookups)
+    return objs
+
+
+def related_page_keys(objs):
+    """Return cache keys of the pages of documents related to 'objs'.
+
+    Pages link to the documents amended, repealed or consolidated by the
+    document, showing their identifiers and titles, so they change with
+    those documents. Relations are followed in both directions, and from
+    consolidations to their base and amending documents. 'objs' are
+    documents of one type. No keys are returned, and no queries made,
+    when the page cache is off.
+    """
+
+    objs = list(objs)
+    if not objs or page_cache() is None:
+        return []
+    model = type(objs[0])
+    ids = [obj.id for obj in objs]
+    related = []
+    if issubclass(model, FSDokument):
+        for name in ('andringar', 'upphavningar', 'konsolideringar'):
+            related_name = model._meta.get_field(name).related_query_name()
+            related.append((model, model.objects.filter(
+                **{name + '__in': ids})))
+            related.append((model, model.objects.filter(
+                **{related_name + '__in': ids})))
+        if issubclass(model, Myndighetsforeskrift):
+            related.append((
+                KonsolideradForeskrift,
+                KonsolideradForeskrift.objects.filter(
+                    models.Q(grundforfattning__in=ids) |
+                    models.Q(senaste_andringsforfattning__in=ids) |
+                    models.Q(grundforfattning__andringar_foreskrift__in=ids))))
+    elif issubclass(model, KonsolideradForeskrift):
+        related.append((
+            Myndighetsforeskrift,
+            Myndighetsforeskrift.objects.filter(
+                models.Q(grundforfattning__in=ids) |
+                models.Q(senaste_andringsforfattning__in=ids))))
+    if not related:
+        return []
+
+    condition = models.Q()
+    for related_model, queryset in related:
+        condition |= models.Q(
+            content_type=ContentType.objects.get_for_model(related_model),
+            object_id__in=queryset.values('id'))
+    keys = []
+    for slug in RDFPost.objects.filter(condition).values_list(
+            'slug', flat=True).distinct():
+        keys.extend(document_page_keys(slug))
+    return keys
+
+
+class FeedArchive(models.Model):
+    """Frozen page of the Atom feed, according to RFC 5005.
+
+    Only used when 'FST_FEED_PAGE_SIZE' is set. When enough entries have
+    been added after the latest archive page, the oldest of them are
+    rendered into a new page which is never changed again. Entries that
+    are updated later show up in the subscription feed once more.
+    """
+
+    number = models.PositiveIntegerField(unique=True)
+
+    # Position of the newest entry in this page, ordered by
+    # ('updated', 'id'). Entries after this belong to later pages.
+    last_updated = models.DateTimeField()
+    last_entry_id = models.PositiveIntegerField()
+
+    data = models.TextField()
+    md5 = models.CharField(max_length=32)
+
+    class Meta:
+        ordering = ('number',)
+        verbose_name = u"Arkiverad flödessida"
+        verbose_name_plural = u"Arkiverade flödessidor"
+
+    def save(self, *args, **kwargs):
+        self.md5 = hashlib.md5(self.data.encode('utf-8')).hexdigest()
+        super(FeedArchive, self).save(*args, **kwargs)
+
+    @classmethod
+    def latest(cls):
+        return cls.objects.order_by('-number').first()
+
+
+def entries_after_archive(archive):
+    """Return Atom entries not yet frozen in 'archive' or earlier pages."""
+
+    entries = AtomEntry.objects.all()
+    if archive:
+        entries = entries.filter(
+            models.Q(updated__gt=archive.last_updated) |
+            models.Q(updated=archive.last_updated,
+                     id__gt=archive.last_entry_id))
+    return entries
+
+
+def feed_context(entries, **extra):
+    """Build template context for a feed document containing 'entries'.
+
+    'entries' must be ordered with the most recently updated first.
+    """
+
+    context = {
+        'entries': entries,
+        'last_updated': rfc3339_date(entries[0].updated) if entries else "",
+        'feed_id': settings.FST_DATASET_URI,
+        'feed_title': settings.FST_DATASET_TITLE,
+        'feed_contact_name': settings.FST_ORG_CONTACT_NAME,
+        'feed_contact_url': settings.FST_ORG_CONTACT_URL,
+        'feed_contact_email': settings.FST_ORG_CONTACT_EMAIL,
+        'fst_instance_url': settings.FST_INSTANCE_URL,
+        'self_path': urlresolvers.reverse('atomfeed'),
+    }
+    context.update(extra)
+    return context
+
+
+def freeze_feed_archives():
+    """Freeze all full pages of the feed and return the latest archive.
+
+    A new archive page is created when 'FST_FEED_PAGE_SIZE' entries have
+    been updated since the latest archive page was frozen. Called when
+    Atom entries are written, so that reading the feed never writes.
+    """
+
+    page_size = settings.FST_FEED_PAGE_SIZE
+    archive = FeedArchive.latest()
+    if not page_size:
+        return archive
+    while True:
+        entries = list(entries_after_archive(archive).
+                       order_by('updated', 'id')[:page_size])
+        if len(entries) < page_size:
+            return archive
+        prefetch_entry_documents(
+            [entry for entry in entries if not entry.entry_xml])
+        number = archive.number + 1 if archive else 1
+        entries.reverse()
+        context = feed_context(
+            entries,
+            archive=True,
+            self_path=urlresolvers.reverse('atomfeed_archive',
+                                           args=[number]),
+            current_path=urlresolvers.reverse('atomfeed'),
+            prev_archive_path=(
+                urlresolvers.reverse('atomfeed_archive', args=[number - 1])
+                if number > 1 else None))
+        try:
+            with transaction.atomic():
+                archive = FeedArchive.objects.create(
+                    number=number,
+                    last_updated=entries[0].updated,
+                    last_entry_id=entries[0].id,
+                    data=loader.render_to_string('atomfeed.xml', context))
+        except IntegrityError:
+            # Page was frozen by a concurrent writer
+            archive = FeedArchive.latest()
+
+
 def delete_entry(sender, instance, **kwargs):
     """Delete associated metadata and atom entry when a document is deleted."""
 
-    existing_meta = RDFPost.get_for(instance)
-    if existing_meta:
-        existing_meta.delete()
-    existing_entry = AtomEntry.get_for(instance)
-    if existing_entry:
-        existing_entry.delete()
+    rdf_posts = RDFPost.filter_for([instance])
+    keys = feed_page_keys()
+    for slug in rdf_posts.values_list('slug', flat=True):
+        keys.extend(document_page_keys(slug))
+    rdf_posts.delete()
+    AtomEntry.filter_for([instance]).delete()
+    invalidate_pages(keys)
 
 
 post_delete.connect(
@@ -771,6 +1292,110 @@ post_delete.connect(
     dispatch_uid="fs_doc.KonsolideradForeskrift.create_delete_signal")
 
 
+def delete_related_pages(sender, instance, **kwargs):
+    """Remove cached pages linking to a document before it is deleted,
+    while its relations can still be found."""
+
+    invalidate_pages(related_page_keys([instance]))
+
+
+pre_delete.connect(
+    delete_related_pages,
+    sender=Myndighetsforeskrift,
+    dispatch_uid="fs_doc.Myndighetsforeskrift.delete_related_pages")
+
+pre_delete.connect(
+    delete_related_pages,
+    sender=AllmannaRad,
+    dispatch_uid="fs_doc.AllmannaRad.delete_related_pages")
+
+pre_delete.connect(
+    delete_related_pages,
+    sender=KonsolideradForeskrift,
+    dispatch_uid="fs_doc.KonsolideradForeskrift.delete_related_pages")
+
+
+def remove_related_pages(sender, instance, action, model, pk_set, **kwargs):
+    """Remove cached pages of documents when relations between them are
+    removed. Pages of related documents are otherwise removed when the
+    document is saved, see 'related_page_keys'."""
+
+    if action == 'pre_clear':
+        keys = related_page_keys([instance])
+    elif action == 'post_remove':
+        keys = []
+        for slug in RDFPost.filter_for(
+                [instance] + list(model.objects.filter(id__in=pk_set))
+        ).values_list('slug', flat=True):
+            keys.extend(document_page_keys(slug))
+    else:
+        return
+    invalidate_pages(keys)
+
+
+for m2m_field in (Myndighetsforeskrift.andringar,
+                  Myndighetsforeskrift.upphavningar,
+                  Myndighetsforeskrift.konsolideringar,
+                  AllmannaRad.andringar,
+                  AllmannaRad.upphavningar,
+                  AllmannaRad.konsolideringar):
+    m2m_changed.connect(
+        remove_related_pages,
+        sender=m2m_field.through,
+        dispatch_uid="fs_doc.%s.remove_related_pages" % (
+            m2m_field.through.__name__))
+
+
+def delete_blob_link(sender, instance, **kwargs):
+    """Remove the stored files of a deleted row when using blobs.
+
+    With 'FST_FILE_BLOBS' the file name is a link to a blob, removed when
+    the deletion is committed unless another row refers to the name. The
+    blob itself is removed by 'gc_blobs'.
+    """
+
+    if not settings.FST_FILE_BLOBS:
+        return
+    for field in sender._meta.fields:
+        if not isinstance(field, models.FileField) or \
+                not isinstance(field.storage, OverwritingStorage):
+            continue
+        name = getattr(instance, field.name).name
+        if not name:
+            continue
+
+        def remove(field=field, name=name):
+            if not sender.objects.filter(**{field.name: name}).exists():
+                field.storage.delete(name)
+        transaction.on_commit(remove)
+
+
+post_delete.connect(
+    delete_blob_link,
+    sender=Myndighetsforeskrift,
+    dispatch_uid="fs_doc.Myndighetsforeskrift.delete_blob_link")
+
+post_delete.connect(
+    delete_blob_link,
+    sender=AllmannaRad,
+    dispatch_uid="fs_doc.AllmannaRad.delete_blob_link")
+
+post_delete.connect(
+    delete_blob_link,
+    sender=KonsolideradForeskrift,
+    dispatch_uid="fs_doc.KonsolideradForeskrift.delete_blob_link")
+
+post_delete.connect(
+    delete_blob_link,
+    sender=Bilaga,
+    dispatch_uid="fs_doc.Bilaga.delete_blob_link")
+
+post_delete.connect(
+    delete_blob_link,
+    sender=OvrigtDokument,
+    dispatch_uid="fs_doc.OvrigtDokument.delete_blob_link")
+
+
 def get_file_md5(opened_file):
     md5sum = hashlib.md5()
     block_size = 128 * md5sum.block_size
@@ -794,37 +1419,195 @@ def to_slug(tag):
 
 
 def generate_atom_entry_for(obj, update_only=False):
+    """Create or update the Atom entry for a document.
+
+    If the entry already exists and nothing that it publishes has changed
+    (such as checksums of RDF and document file, title or summary), nothing
+    is written and the entry keeps its 'updated' timestamp.
+    """
+
     updated = datetime.utcnow()
 
     # Check if we already published this document
-    obj_type = ContentType.objects.get_for_model(obj)
-    entries = AtomEntry.objects.filter(content_type__pk=obj_type.id,
-                                       object_id=obj.id)
-    # Find entry for object
-    for entry in entries.order_by("published"):
-        entry_published = entry.published
-        break
-    else:
+    entry = AtomEntry.get_for(obj)
+    if not entry:
         if update_only:
             return
         # For new documents
-        entry_published = updated
+        entry = AtomEntry(content_object=obj, published=updated)
 
     # Get RDF representation of object
     rdf_post = RDFPost.get_for(obj)
 
-    entry = AtomEntry.get_or_create(obj)
+    if _update_atom_entry(entry, obj, rdf_post, updated):
+        entry.save()
+        freeze_feed_archives()
+        invalidate_pages(feed_page_keys())
+    return entry
+
+
+def _update_atom_entry(entry, obj, rdf_post, updated):
+    """Set fields of 'entry' for 'obj' without saving it.
+
+    Returns False if the entry already exists and is unchanged.
+    """
+
+    entry.content_object = obj
     entry.entry_id = obj.get_rinfo_uri()
-    entry.updated = updated
-    entry.published = entry_published
     entry.rdf_post = rdf_post
-    entry.save()
+    if entry.pk and entry.entry_xml == entry.render_entryxml():
+        # Rendered with the previous timestamp, so unchanged
+        return False
+    entry.updated = updated
+    entry.xml_changed = updated
+    entry.entry_xml = entry.render_entryxml()
+    return True
+
+
+def _bulk_update(model, objs, field_names, **values):
+    """Write 'field_names' of saved 'objs', and 'values' to all of them.
+
+    Django 1.11 has no 'bulk_update', so each batch of objects is written
+    with one UPDATE selecting the values by primary key.
+    """
+
+    fields = [model._meta.get_field(name) for name in field_names]
+    # Keeps the parameters of a statement below the limit of SQLite
+    batch_size = 900 // (2 * len(fields) + 1)
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        cases = {}
+        for field in fields:
+            cases[field.name] = models.Case(*[
+                models.When(pk=obj.pk,
+                            then=models.Value(getattr(obj, field.attname)))
+                for obj in batch],
+                output_field=field.target_field if field.is_relation
+                else field)
+        cases.update(values)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(
+            **cases)
+
+
+def _write_documents(objs, updated, update_only):
+    """Generate RDF posts and Atom entries of documents of one type.
+
+    Only changed posts and entries are written. With 'update_only', no
+    new entries are created. Returns number of entries written and keys
+    of the cached pages showing the documents.
+    """
+
+    rdf_posts = RDFPost.get_for_objects(objs)
+    keys = []
+    new_posts = []
+    changed_posts = []
+    for obj in objs:
+        slug = obj.get_fs_dokument_slug()
+        data = obj.to_rdfxml()
+        md5 = hashlib.md5(data.encode('utf-8')).hexdigest()
+        keys.extend(document_page_keys(slug))
+        rdf_post = rdf_posts.get(obj)
+        if rdf_post is None:
+            new_posts.append(RDFPost(content_object=obj, slug=slug,
+                                     data=data, md5=md5))
+        elif rdf_post.slug != slug or rdf_post.md5 != md5:
+            keys.extend(document_page_keys(rdf_post.slug))
+            rdf_post.slug = slug
+            rdf_post.data = data
+            rdf_post.md5 = md5
+            changed_posts.append(rdf_post)
+    _bulk_update(RDFPost, changed_posts, ['slug', 'data', 'md5'])
+    if new_posts:
+        RDFPost.objects.bulk_create(new_posts)
+        # Primary keys are not set by bulk_create on all databases
+        rdf_posts = RDFPost.get_for_objects(objs)
+
+    entries = AtomEntry.get_for_objects(objs)
+    new_entries = []
+    changed_entries = []
+    for obj in objs:
+        entry = entries.get(obj)
+        if entry is None:
+            if update_only:
+                continue
+            entry = AtomEntry(published=updated)
+        if _update_atom_entry(entry, obj, rdf_posts.get(obj), updated):
+            if entry.pk:
+                changed_entries.append(entry)
+            else:
+                new_entries.append(entry)
+    AtomEntry.objects.bulk_create(new_entries)
+    _bulk_update(AtomEntry, changed_entries,
+                 ['entry_id', 'rdf_post', 'entry_xml'],
+                 updated=updated, xml_changed=updated)
+
+    if new_entries or changed_entries:
+        freeze_feed_archives()
+        keys.extend(feed_page_keys())
+    keys.extend(related_page_keys(objs))
+    return len(new_entries) + len(changed_entries), keys
+
+
+def publish_documents(objs):
+    """Publish documents of one type in a single transaction.
+
+    RDF posts are generated, Atom entries are created or updated, and
+    'is_published' is set where the model has it. Posts and entries of
+    unchanged documents are not written. Returns number of entries
+    written.
+    """
+
+    objs = prefetch_documents(objs)
+    if not objs:
+        return 0
+    model = type(objs[0])
+    with transaction.atomic():
+        written, keys = _write_documents(objs, datetime.utcnow(),
+                                         update_only=False)
+        if any(f.name == 'is_published' for f in model._meta.fields):
+            model.objects.filter(id__in=[obj.id for obj in objs]).update(
+                is_published=True)
+        # Pages show the current document, so all of them are removed
+        invalidate_pages(keys)
+    return written
+
+
+def update_documents(objs):
+    """Update RDF posts and existing Atom entries of documents of one type.
+
+    Does in a single transaction what saving each document in the admin
+    does, see 'generate_rdf_post_for'. Returns number of entries written.
+    """
+
+    objs = prefetch_documents(objs)
+    if not objs:
+        return 0
+    with transaction.atomic():
+        written, keys = _write_documents(objs, datetime.utcnow(),
+                                         update_only=True)
+        invalidate_pages(keys)
+    return written
 
 
 def generate_rdf_post_for(obj):
-    # Create RDF metadata
+    """Create or update RDF metadata for a document.
+
+    Nothing is written if the metadata is unchanged.
+    """
+
     rdf_post = RDFPost.get_or_create(obj)
-    rdf_post.slug = obj.get_fs_dokument_slug()
-    rdf_post.data = obj.to_rdfxml()
+    slug = obj.get_fs_dokument_slug()
+    data = obj.to_rdfxml()
+    # The HTML page shows the current document, so it is removed from the
+    # cache even if the RDF is unchanged, as are pages linking to it
+    keys = document_page_keys(slug) + related_page_keys([obj])
+    if rdf_post.pk and rdf_post.slug != slug:
+        keys.extend(document_page_keys(rdf_post.slug))
+    invalidate_pages(keys)
+    if rdf_post.pk and rdf_post.slug == slug and \
+            rdf_post.md5 == hashlib.md5(data.encode('utf-8')).hexdigest():
+        return rdf_post
+    rdf_post.slug = slug
+    rdf_post.data = data
     rdf_post.save()
     return rdf_post
@@ -1,4 +1,6 @@
 # -*- coding: UTF-8 -*-
+import re
+from xml.sax.saxutils import escape, quoteattr
 from rdflib import Graph, BNode, Literal, Namespace, RDF, URIRef
 
 
@@ -9,6 +11,17 @@ RPUBL = Namespace("http://rinfo.lagrummet.se/ns/2008/11/rinfo/publ#")
 
 RINFO_BASE = "http://rinfo.lagrummet.se"
 
+# Prefixes used when writing RDF/XML. RPUBL is the default namespace.
+NAMESPACES = (
+    ('rdf', str(RDF)),
+    ('dct', str(DCT)),
+    ('dces', str(DCES)),
+    ('foaf', str(FOAF)),
+    ('', str(RPUBL)),
+)
+
+NCNAME = re.compile(r'^[A-Za-z_][\w.-]*$')
+
 
 def eur_lex_ref(celexnum):
     return URIRef("%s/ext/eur-lex/%s" % (RINFO_BASE, celexnum))
@@ -18,15 +31,140 @@ def sfs_ref(sfsnum):
     return URIRef("%s/publ/sfs/%s" % (RINFO_BASE, sfsnum))
 
 
+def unique_triples(triples):
+    """Remove duplicate triples, keeping the order of the first ones"""
+
+    seen = set()
+    for triple in triples:
+        if triple not in seen:
+            seen.add(triple)
+            yield triple
+
+
+class RDFXMLWriter(object):
+    """Write triples as RDF/XML without building an rdflib graph.
+
+    Triples are grouped by subject into one node element each, typed by
+    the first 'rdf:type' of the subject. Blank nodes are written with
+    'rdf:nodeID'.
+    """
+
+    def __init__(self, triples):
+        self.triples = list(unique_triples(triples))
+        self.prefixes = dict((uri, prefix) for prefix, uri in NAMESPACES)
+        self.extra_namespaces = []
+        self.node_ids = {}
+
+    def qname(self, uri):
+        uri = str(uri)
+        for namespace, prefix in self.prefixes.items():
+            if uri.startswith(namespace) and \
+                    NCNAME.match(uri[len(namespace):]):
+                local = uri[len(namespace):]
+                return "%s:%s" % (prefix, local) if prefix else local
+        # Declare namespace for URI not covered by NAMESPACES
+        split = max(uri.rfind('#'), uri.rfind('/')) + 1
+        prefix = "ns%s" % (len(self.extra_namespaces) + 1)
+        self.prefixes[uri[:split]] = prefix
+        self.extra_namespaces.append((prefix, uri[:split]))
+        return "%s:%s" % (prefix, uri[split:])
+
+    def node_id(self, bnode):
+        if bnode not in self.node_ids:
+            self.node_ids[bnode] = "b%s" % (len(self.node_ids) + 1)
+        return self.node_ids[bnode]
+
+    def subject_attr(self, subject):
+        if isinstance(subject, BNode):
+            return 'rdf:nodeID="%s"' % self.node_id(subject)
+        return 'rdf:about=%s' % quoteattr(str(subject))
+
+    def property_element(self, predicate, obj):
+        name = self.qname(predicate)
+        if isinstance(obj, BNode):
+            return '<%s rdf:nodeID="%s"/>' % (name, self.node_id(obj))
+        if isinstance(obj, URIRef):
+            return '<%s rdf:resource=%s/>' % (name, quoteattr(str(obj)))
+        if obj.language:
+            attr = ' xml:lang=%s' % quoteattr(obj.language)
+        elif obj.datatype:
+            attr = ' rdf:datatype=%s' % quoteattr(str(obj.datatype))
+        else:
+            attr = ''
+        return '<%s%s>%s</%s>' % (name, attr, escape(str(obj)), name)
+
+    def node_elements(self):
+        subjects = []
+        properties = {}
+        for s, p, o in self.triples:
+            if s not in properties:
+                subjects.append(s)
+                properties[s] = []
+            properties[s].append((p, o))
+
+        for subject in subjects:
+            props = properties[subject]
+            node_name = "rdf:Description"
+            for i, (p, o) in enumerate(props):
+                if p == RDF.type and isinstance(o, URIRef):
+                    node_name = self.qname(o)
+                    props = props[:i] + props[i + 1:]
+                    break
+            lines = ['  <%s %s>' % (node_name, self.subject_attr(subject))]
+            for p, o in props:
+                lines.append('    ' + self.property_element(p, o))
+            lines.append('  </%s>' % node_name)
+            yield "\n".join(lines)
+
+    def serialize(self):
+        # Node elements first, since they may declare extra namespaces
+        body = list(self.node_elements())
+        declarations = []
+        for prefix, uri in NAMESPACES + tuple(self.extra_namespaces):
+            attr = "xmlns:%s" % prefix if prefix else "xmlns"
+            declarations.append('%s=%s' % (attr, quoteattr(uri)))
+        return '<?xml version="1.0" encoding="utf-8"?>\n' \
+               '<rdf:RDF\n  %s\n>\n%s\n</rdf:RDF>\n' % (
+                   "\n  ".join(declarations), "\n".join(body))
+
+
+def to_ntriples_term(term, node_ids):
+    if isinstance(term, BNode):
+        if term not in node_ids:
+            node_ids[term] = "b%s" % (len(node_ids) + 1)
+        return "_:%s" % node_ids[term]
+    if isinstance(term, URIRef):
+        return "<%s>" % term
+    lexical = str(term).replace('\\', '\\\\').replace('"', '\\"').\
+        replace('\n', '\\n').replace('\r', '\\r')
+    if term.language:
+        return '"%s"@%s' % (lexical, term.language)
+    if term.datatype:
+        return '"%s"^^<%s>' % (lexical, term.datatype)
+    return '"%s"' % lexical
+
+
 class Description(object):
 
+    def triples(self):
+        """Return list of (subject, predicate, object) for the document"""
+        return []
+
+    def to_rdf(self):
+        graph = Graph()
+        for triple in self.triples():
+            graph.add(triple)
+        return graph
+
     def to_rdfxml(self):
-        graph = self.to_rdf()
-        graph.namespace_manager.bind('dct', DCT)
-        graph.namespace_manager.bind('dces', DCES)
-        graph.namespace_manager.bind('foaf', FOAF)
-        graph.namespace_manager.bind('', RPUBL)
-        return graph.serialize(format='pretty-xml')
+        return RDFXMLWriter(self.triples()).serialize()
+
+    def to_ntriples(self):
+        node_ids = {}
+        return "".join(
+            "%s %s %s .\n" % tuple(to_ntriples_term(term, node_ids)
+                                   for term in triple)
+            for triple in unique_triples(self.triples()))
 
 
 class DocumentDescription(Description):
@@ -35,24 +173,24 @@ class DocumentDescription(Description):
         self.obj = obj
         self.ref = URIRef(obj.get_rinfo_uri())
 
-    def to_rdf(self):
-        graph = Graph()
+    def triples(self):
+        triples = []
         obj = self.obj
-        add = lambda p, o: graph.add((self.ref, p, o))
+        add = lambda p, o: triples.append((self.ref, p, o))
 
         add(DCT.title, Literal(obj.titel, lang='sv'))
         add(DCT.identifier, Literal(obj.identifierare))
         add(DCT.publisher, URIRef(obj.get_publisher_uri()))
 
-        return graph
+        return triples
 
 
 class FSDokumentDescription(DocumentDescription):
 
-    def to_rdf(self):
-        graph = super(FSDokumentDescription, self).to_rdf()
+    def triples(self):
+        triples = super(FSDokumentDescription, self).triples()
         obj = self.obj
-        add = lambda p, o: graph.add((self.ref, p, o))
+        add = lambda p, o: triples.append((self.ref, p, o))
 
         add(RPUBL.forfattningssamling,
                 URIRef(obj.forfattningssamling.get_rinfo_uri()))
@@ -75,28 +213,26 @@ class FSDokumentDescription(DocumentDescription):
         for amnesord in obj.amnesord.all():
             add(DCES.subject, Literal(amnesord.titel, lang="sv"))
 
-        return graph
+        return triples
 
 
 class AllmanaRadDescription(FSDokumentDescription):
 
-    def to_rdf(self):
-        graph = super(AllmanaRadDescription, self).to_rdf()
-        graph.add((self.ref, RDF.type, RPUBL.AllmannaRad))
-        obj = self.obj
-        add = lambda p, o: graph.add((self.ref, p, o))
+    def triples(self):
+        triples = super(AllmanaRadDescription, self).triples()
+        add = lambda p, o: triples.append((self.ref, p, o))
 
         add(RDF.type, RPUBL.AllmannaRad)
 
-        return graph
+        return triples
 
 
 class MyndighetsforeskriftDescription(FSDokumentDescription):
 
-    def to_rdf(self):
-        graph = super(MyndighetsforeskriftDescription, self).to_rdf()
+    def triples(self):
+        triples = super(MyndighetsforeskriftDescription, self).triples()
         obj = self.obj
-        add = lambda p, o: graph.add((self.ref, p, o))
+        add = lambda p, o: triples.append((self.ref, p, o))
 
         add(RDF.type, RPUBL.Myndighetsforeskrift)
 
@@ -107,7 +243,8 @@ class MyndighetsforeskriftDescription(FSDokumentDescription):
         for bemyndigande in obj.bemyndiganden.all():
             bemyndigande_ref = BNode()
             add(RPUBL.bemyndigande, bemyndigande_ref)
-            bemyndigande_add = lambda p, o: graph.add((bemyndigande_ref, p, o))
+            bemyndigande_add = lambda p, o: triples.append(
+                (bemyndigande_ref, p, o))
             bemyndigande_add(RDF.type, RPUBL.Forfattningsreferens)
             bemyndigande_add(RPUBL.angerGrundforfattning,
                              sfs_ref(bemyndigande.sfsnummer))
@@ -122,25 +259,25 @@ class MyndighetsforeskriftDescription(FSDokumentDescription):
                 bilaga_ref = URIRef("%s#bilaga_%s" %
                                     (obj.get_rinfo_uri(), i+1))
                 add(RPUBL.bilaga, bilaga_ref)
-                graph.add((bilaga_ref, DCT.title,
-                           Literal(bilaga.titel)))  # no lang?
+                triples.append((bilaga_ref, DCT.title,
+                                Literal(bilaga.titel)))  # no lang?
 
         for dok in obj.ovriga_dokument.all():
             dok_ref = URIRef("%s/%s" % (obj.get_rinfo_uri(), dok.file.url))
-            dok_add = lambda p, o: graph.add((dok_ref, p, o))
+            dok_add = lambda p, o: triples.append((dok_ref, p, o))
             dok_add(RDF.type, FOAF.Document)
             dok_add(DCT.title, Literal(dok.titel, lang="sv"))
             dok_add(FOAF.primaryTopic, self.ref)
 
-        return graph
+        return triples
 
 
 class KonsolideradForeskriftDescription(DocumentDescription):
 
-    def to_rdf(self):
-        graph = super(KonsolideradForeskriftDescription, self).to_rdf()
+    def triples(self):
+        triples = super(KonsolideradForeskriftDescription, self).triples()
         obj = self.obj
-        add = lambda p, o: graph.add((self.ref, p, o))
+        add = lambda p, o: triples.append((self.ref, p, o))
 
         add(RDF.type, RPUBL.KonsolideradGrundforfattning)
         add(DCT.issued, Literal(obj.konsolideringsdatum))
@@ -150,5 +287,4 @@ class KonsolideradForeskriftDescription(DocumentDescription):
         for dok in obj.get_konsolideringsunderlag():
             add(RPUBL.konsolideringsunderlag, URIRef(dok.get_rinfo_uri()))
 
-        return graph
-
+        return triples
@@ -1,15 +1,37 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import os
+import re
 import shutil
+import sqlite3
+import tempfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from xml.dom.minidom import parseString
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test import override_settings
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
 from rdflib import Graph, Literal, URIRef, RDF
+from rdflib.compare import isomorphic
 from django.core.urlresolvers import reverse
 from fst_web.fs_doc import models
+from fst_web.fs_doc.bulkload import DuplicateRowsError, bulk_load
+from fst_web.fs_doc.cache import LRUMemoryCache, page_cache, page_key
+from fst_web.fs_doc.management.commands import importfeed
 from fst_web.fs_doc.models import generate_atom_entry_for
 from fst_web.fs_doc.models import generate_rdf_post_for
+from fst_web.fs_doc.titleindex import TitleIndex
+from fst_web.fs_doc.uploadhandlers import ChecksumMemoryFileUploadHandler
+from fst_web.fs_doc.uploadhandlers import ChecksumTemporaryFileUploadHandler
 from fst_web.fs_doc.rdfviews import DCT, DCES, RPUBL, RINFO_BASE
 
 
@@ -89,6 +111,175 @@ class EditorUserTestCase(TestCase):
         self.assertNotContains(response, "auth")
         self.assertContains(response, "fs_doc")
 
+    def test_next_lopnummer(self):
+        """Verify that add form suggests next number in the collection"""
+
+        self.assertEqual(models.next_lopnummer(arsutgava="2009"), 4)
+        self.assertEqual(models.next_lopnummer(arsutgava="2009",
+                                               forfattningssamling=2), 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                '/admin/fs_doc/myndighetsforeskrift/add/?arsutgava=2009')
+        self.assertContains(response, 'id="id_lopnummer">\n4</textarea>')
+        # Only the admin suggests the number, not the field default
+        self.assertEqual(len([query for query in queries
+                              if 'CAST' in query['sql']]), 1)
+
+    def test_stored_identifiers(self):
+        """Verify that stored identifiers are used and kept in sync"""
+
+        call_command('update_identifiers', stdout=StringIO())
+        foreskrift = models.Myndighetsforeskrift.objects.get(pk=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(foreskrift.identifierare, "EXFS 2009:1")
+            self.assertEqual(foreskrift.get_rinfo_uri(),
+                             RINFO_BASE + "/publ/exfs/2009:1")
+
+        forfattningssamling = foreskrift.forfattningssamling
+        forfattningssamling.kortnamn = "NYFS"
+        forfattningssamling.slug = "nyfs"
+        forfattningssamling.save()
+        self.assertEqual(
+            models.FSDokument.objects.get(
+                cached_slug="nyfs/2009:1").cached_identifierare,
+            "NYFS 2009:1")
+
+        foreskrift.lopnummer = "10"
+        foreskrift.save()
+        self.assertEqual(
+            models.FSDokument.objects.get(pk=1).cached_rinfo_uri,
+            RINFO_BASE + "/publ/nyfs/2009:10")
+
+    def test_changelist_query_count(self):
+        """Verify that changelist queries don't depend on number of rows"""
+
+        url = '/admin/fs_doc/myndighetsforeskrift/'
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as before:
+            response = self.client.get(url)
+        self.assertContains(response, u"Ändringsförfattning")
+
+        for lopnummer in ("10", "11", "12"):
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=3)
+            foreskrift.pk = foreskrift.id = None
+            foreskrift.lopnummer = lopnummer
+            foreskrift.save()
+        with self.assertNumQueries(len(before)):
+            self.client.get(url)
+
+    def test_report_pagination(self):
+        """Verify that reports are paginated with a constant number of
+        queries"""
+
+        with CaptureQueriesContext(connection) as before:
+            response = self.client.get('/admin/not_published')
+        self.assertContains(response, u"Ändringsförfattning")
+        self.assertNotContains(response, "?p=2")
+
+        for lopnummer in range(10, 40):
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=3)
+            foreskrift.pk = foreskrift.id = None
+            foreskrift.lopnummer = str(lopnummer)
+            foreskrift.save()
+        with self.assertNumQueries(len(before)):
+            response = self.client.get('/admin/not_published')
+        self.assertContains(response, "?p=2")
+        response = self.client.get('/admin/not_published?p=2')
+        self.assertContains(response, "EXFS 2009:2")
+        self.assertEqual(
+            self.client.get('/admin/not_published?p=3').status_code, 404)
+
+    def test_page_cache_stats(self):
+        """Verify that statistics of the page cache are displayed"""
+
+        response = self.client.get('/admin/page_cache')
+        self.assertContains(response, u"avstängd")
+        with self.settings(FST_PAGE_CACHE='fst_pages'):
+            response = self.client.get('/admin/page_cache')
+        self.assertContains(response, u"Träffar")
+
+    def test_report_amnesord(self):
+        """Verify that documents are listed per keyword with a constant
+        number of queries"""
+
+        with CaptureQueriesContext(connection) as before:
+            response = self.client.get('/admin/amnesord')
+        self.assertContains(response, "Administration")
+        self.assertContains(response, "EXFS 2009:1")
+        self.assertContains(response, "/admin/fs_doc/allmannarad/4/")
+
+        for lopnummer in ("10", "11", "12"):
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=1)
+            amnesord = list(foreskrift.amnesord.all())
+            foreskrift.pk = foreskrift.id = None
+            foreskrift.lopnummer = lopnummer
+            foreskrift.save()
+            foreskrift.amnesord.set(amnesord)
+        with self.assertNumQueries(len(before)):
+            response = self.client.get('/admin/amnesord')
+        self.assertContains(response, "EXFS 2009:12")
+
+    def test_publish_action(self):
+        """Verify that selected documents are published together"""
+
+        models.RDFPost.objects.all().delete()
+        url = '/admin/fs_doc/myndighetsforeskrift/'
+        post_data = {'action': 'make_published',
+                     '_selected_action': ['1', '2', '3']}
+        response = self.client.post(url, post_data, follow=True)
+        self.assertContains(response, u"3 dokument har publicerats "
+                                       u"(0 oförändrade).")
+        for foreskrift in models.Myndighetsforeskrift.objects.all():
+            self.assertTrue(foreskrift.is_published)
+            entry = models.AtomEntry.get_for(foreskrift)
+            self.assertEqual(entry.rdf_post, models.RDFPost.get_for(foreskrift))
+            self.assertIn(entry.rdf_post.md5, entry.entry_xml)
+
+        response = self.client.post(url, post_data, follow=True)
+        self.assertContains(response, u"3 dokument har publicerats "
+                                       u"(3 oförändrade).")
+
+    def test_publish_documents_queries(self):
+        """Verify that documents are published with a constant number of
+        queries"""
+
+        def publish_queries(titel):
+            models.Myndighetsforeskrift.objects.update(titel=titel)
+            foreskrifter = list(models.Myndighetsforeskrift.objects.all())
+            with CaptureQueriesContext(connection) as queries:
+                models.publish_documents(foreskrifter)
+            return len(queries)
+
+        models.RDFPost.objects.all().delete()
+        models.AtomEntry.objects.all().delete()
+        # New entries, then changed entries
+        before = [publish_queries("Titel"), publish_queries("Ny titel")]
+
+        for lopnummer in range(10, 40):
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=2)
+            related = [list(getattr(foreskrift, name).all()) for name in (
+                'amnesord', 'andringar', 'bemyndiganden', 'celexreferenser')]
+            foreskrift.pk = foreskrift.id = None
+            foreskrift.lopnummer = str(lopnummer)
+            foreskrift.save()
+            for name, objs in zip(('amnesord', 'andringar', 'bemyndiganden',
+                                   'celexreferenser'), related):
+                getattr(foreskrift, name).set(objs)
+        models.RDFPost.objects.all().delete()
+        models.AtomEntry.objects.all().delete()
+        self.assertEqual(
+            [publish_queries("Titel"), publish_queries("Ny titel")], before)
+        self.assertEqual(models.AtomEntry.objects.filter(
+            entry_xml__contains="Ny titel").count(), 33)
+
+    def test_duplicate_lopnummer(self):
+        """Verify that a number can't be used twice in a collection"""
+
+        foreskrift = models.Myndighetsforeskrift.objects.get(pk=3)
+        foreskrift.pk = foreskrift.id = None
+        foreskrift.lopnummer = "1"
+        self.assertRaises(ValidationError, foreskrift.validate_unique)
+
     def test_report_beslutsdatum(self):
         """Verify that editor can access report"""
 
@@ -277,6 +468,93 @@ class FeedTestCase(TestCase):
                 beraknad_rdfmd5 = md5.hexdigest()
                 self.assertEqual(beraknad_rdfmd5, avlast_md5)
 
+    @override_settings(FST_PAGE_CACHE='fst_pages')
+    def test_page_cache(self):
+        """Verify that public views are cached until documents change"""
+
+        rdf_path = '/publ/exfs/2009:1/rdf'
+        html_path = '/publ/exfs/2009:1/'
+        page_cache().clear()
+        hits = page_cache().stats()['hits']
+        for path in (rdf_path, html_path, '/feed/'):
+            self.client.get(path)
+            with self.assertNumQueries(0):
+                response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertEqual(self.client.get(
+            '/feed/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # Publishing removes the pages of the document and the feed
+        foreskrift = models.Myndighetsforeskrift.objects.get(pk=1)
+        foreskrift.titel = "Ny titel"
+        foreskrift.save()
+        generate_rdf_post_for(foreskrift)
+        generate_atom_entry_for(foreskrift)
+        self.assertContains(self.client.get(rdf_path), "Ny titel")
+        self.assertContains(self.client.get(html_path), "Ny titel")
+        self.assertContains(self.client.get('/feed/'), "Ny titel")
+
+        # Deleting removes them too
+        foreskrift.delete()
+        self.assertEqual(self.client.get(rdf_path).status_code, 404)
+        self.assertNotContains(self.client.get('/feed/'), "Ny titel")
+
+        stats = page_cache().stats()
+        self.assertEqual(stats['hits'] - hits, 4)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_export_static(self):
+        """Verify that the public site is exported, incrementally"""
+
+        directory = tempfile.mkdtemp()
+        try:
+            out = StringIO()
+            call_command('export_static', directory, stdout=out)
+            self.assertIn("11 files written, 0 unchanged", out.getvalue())
+            with open(os.path.join(directory, 'publ/exfs/2009:1/rdf'),
+                      'rb') as f:
+                self.assertEqual(
+                    f.read(),
+                    self.client.get('/publ/exfs/2009:1/rdf').content)
+            with open(os.path.join(directory, 'feed/index.xml'), 'rb') as f:
+                self.assertEqual(f.read(), self.client.get('/feed/').content)
+            with open(os.path.join(directory,
+                                   'publ/exfs/2009:1/index.html')) as f:
+                self.assertIn("Föreskrifter om administration", f.read())
+
+            # HTML pages showing the document are written when they
+            # change, also before the RDF
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=1)
+            foreskrift.titel = "Ny titel"
+            foreskrift.save()
+            out = StringIO()
+            call_command('export_static', directory, stdout=out)
+            self.assertIn("3 files written, 8 unchanged, 0 removed",
+                          out.getvalue())
+            with open(os.path.join(directory,
+                                   'publ/exfs/2009:1/index.html')) as f:
+                self.assertIn("Ny titel", f.read())
+
+            # Only the feed and RDF of the republished document are written
+            generate_rdf_post_for(foreskrift)
+            generate_atom_entry_for(foreskrift)
+            out = StringIO()
+            call_command('export_static', directory, stdout=out)
+            self.assertIn("2 files written, 9 unchanged, 0 removed",
+                          out.getvalue())
+
+            # The consolidation based on the document is deleted with it
+            models.Myndighetsforeskrift.objects.get(pk=2).delete()
+            out = StringIO()
+            call_command('export_static', directory, stdout=out)
+            self.assertIn("1 files written, 6 unchanged, 4 removed",
+                          out.getvalue())
+            self.assertFalse(os.path.exists(
+                os.path.join(directory, 'publ/exfs/2009:2')))
+        finally:
+            shutil.rmtree(directory)
+
     def test_delete_related_metadata(self):
         """Verify that related metadata is deleted when document is deleted"""
 
@@ -329,6 +607,22 @@ class FeedTestCase(TestCase):
         # Only one document entry exists
         self.assertEquals(len(dom.getElementsByTagNameNS(NS_ATOM, 'entry')), 1)
 
+    def test_get_for_objects(self):
+        """Verify that entries of many documents are found in one query"""
+
+        docs = list(models.Myndighetsforeskrift.objects.all())
+        docs.append(models.KonsolideradForeskrift.objects.get(pk=1))
+        for doc in docs:
+            models.ContentType.objects.get_for_model(doc)
+        with self.assertNumQueries(1):
+            entries = models.AtomEntry.get_for_objects(docs)
+        self.assertEqual(
+            sorted(doc.identifierare for doc in entries),
+            ["EXFS 2009:1", "EXFS 2009:2"])
+        for doc, entry in entries.items():
+            self.assertEqual(entry.object_id, doc.id)
+        self.assertEqual(models.AtomEntry.get_for_objects([]), {})
+
     def test_delete_feedentry(self):
         """Verify that deleted entries are NOT replaced by special entry.
 
@@ -353,6 +647,207 @@ class FeedTestCase(TestCase):
         # There is no special entry signaling deletion
         self.assertFalse(dom.getElementsByTagNameNS(NS_AT, 'deleted-entry'))
 
+    def test_feed_uses_stored_entries(self):
+        """Verify that feed is built from stored entry fragments"""
+
+        entry = models.AtomEntry.objects.order_by('id')[0]
+        self.assertIn("<entry>", entry.entry_xml)
+        models.AtomEntry.objects.filter(pk=entry.pk).update(
+            entry_xml=entry.entry_xml.replace(
+                entry.entry_id, "tag:stored"))
+        response = self.client.get('/feed/')
+        self.assertContains(response, "<id>tag:stored</id>")
+
+        # Rebuilding restores the rendered fragment and changes the ETag
+        call_command('rebuild_atom_entries', stdout=StringIO())
+        rebuilt = self.client.get('/feed/',
+                                  HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(rebuilt.status_code, 200)
+        self.assertNotContains(rebuilt, "tag:stored")
+        self.assertContains(rebuilt, "<id>%s</id>" % entry.entry_id)
+
+    def test_feed_etag_changes_on_collection_rename(self):
+        """Verify that renaming a collection changes the feed ETag"""
+
+        etag = self.client.get('/feed/')['ETag']
+        forfattningssamling = models.Forfattningssamling.objects.get(
+            slug="exfs")
+        forfattningssamling.kortnamn = "NYFS"
+        forfattningssamling.save()
+        self.assertEqual(self.client.get(
+            '/feed/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @override_settings(FST_PAGE_CACHE='fst_pages')
+    def test_page_cache_on_collection_rename(self):
+        """Verify that renaming a collection removes its cached pages and
+        publishes the documents by their new identifiers"""
+
+        page_cache().clear()
+        etag = self.client.get('/feed/')['ETag']
+        self.assertContains(self.client.get('/publ/exfs/2009:1/'),
+                            "EXFS 2009:1")
+        self.assertContains(self.client.get('/publ/exfs/2009:1/rdf'),
+                            "/publ/exfs/2009:1")
+        forfattningssamling = models.Forfattningssamling.objects.get(
+            slug="exfs")
+        forfattningssamling.kortnamn = "NYFS"
+        forfattningssamling.slug = "nyfs"
+        forfattningssamling.save()
+
+        response = self.client.get('/feed/')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, "/publ/nyfs/2009:1<")
+        self.assertContains(response, "/publ/nyfs/2009:1/rdf")
+        self.assertNotContains(response, "/publ/exfs/")
+        self.assertEqual(
+            self.client.get('/publ/exfs/2009:1/').status_code, 404)
+        self.assertEqual(
+            self.client.get('/publ/exfs/2009:1/rdf').status_code, 404)
+        self.assertContains(self.client.get('/publ/nyfs/2009:1/'),
+                            "NYFS 2009:1")
+        response = self.client.get('/publ/nyfs/2009:1/rdf')
+        self.assertContains(response, "/publ/nyfs/2009:1")
+        self.assertNotContains(response, "/publ/exfs/")
+
+    @override_settings(FST_PAGE_CACHE='fst_pages')
+    def test_page_cache_of_related_documents(self):
+        """Verify that pages showing a document are removed when it is
+        saved, and when relations to it are removed"""
+
+        page_cache().clear()
+        base_key = page_key('fs_dokument', 'exfs/2009:1')
+        consolidation_path = '/publ/exfs/2009:1/konsolidering/2011-05-30/'
+        for path in ('/publ/exfs/2009:1/', '/publ/exfs/2009:2/',
+                     consolidation_path):
+            self.assertEqual(self.client.get(path).status_code, 200)
+        self.assertTrue(page_cache().has_key(base_key))
+
+        # Saved as in the admin
+        amending = models.Myndighetsforeskrift.objects.get(pk=2)
+        amending.titel = "Andrad titel"
+        amending.save()
+        generate_rdf_post_for(amending)
+        self.assertFalse(page_cache().has_key(base_key))
+        self.assertContains(self.client.get(consolidation_path),
+                            "Andrad titel")
+
+        base = models.Myndighetsforeskrift.objects.get(pk=1)
+        base.titel = "Andrad grundforfattning"
+        base.save()
+        generate_rdf_post_for(base)
+        self.assertContains(self.client.get('/publ/exfs/2009:2/'),
+                            "Andrad grundforfattning")
+
+        self.client.get('/publ/exfs/2009:1/')
+        amending.andringar.remove(base)
+        self.assertFalse(page_cache().has_key(base_key))
+
+    def test_feed_query_count_is_constant(self):
+        """Verify that rendering entries does not query once per entry"""
+
+        def count_feed_queries():
+            # Force rendering of all entries
+            models.AtomEntry.objects.update(entry_xml="")
+            with CaptureQueriesContext(connection) as queries:
+                dom = self._get_parsed_feed('/feed/')
+            entries = dom.getElementsByTagNameNS(NS_ATOM, 'entry')
+            return len(entries), len(queries)
+
+        def publish(modeltype, arsutgava, lopnummer):
+            doc = modeltype.objects.get(
+                forfattningssamling__slug="exfs",
+                arsutgava=arsutgava, lopnummer=lopnummer)
+            generate_rdf_post_for(doc)
+            generate_atom_entry_for(doc)
+
+        # Queries are made per document type, so include all types first
+        publish(models.AllmannaRad, "2011", "1")
+        entry_count, query_count = count_feed_queries()
+        self.assertEqual(entry_count, 3)
+
+        publish(models.Myndighetsforeskrift, "2009", "3")
+        self.assertEqual(count_feed_queries(), (4, query_count))
+
+    @override_settings(FST_FEED_STREAMING=True)
+    def test_streamed_feed(self):
+        """Verify that streamed feed has the same content"""
+
+        def normalized(xml):
+            return re.sub(r'>\s+<', '><', xml)
+
+        with self.settings(FST_FEED_STREAMING=False):
+            expected = normalized(self._get_parsed_feed('/feed/').toxml())
+        # Also render one of the entries while streaming
+        models.AtomEntry.objects.filter(
+            id=models.AtomEntry.objects.order_by('id')[0].id).update(
+            entry_xml="")
+        response = self.client.get('/feed/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['content-type'],
+                         'application/atom+xml; charset=utf-8')
+        dom = parseString(b"".join(response.streaming_content))
+        self.assertEqual(normalized(dom.toxml()), expected)
+
+    def test_unchanged_document_is_not_written(self):
+        """Verify that saving unchanged metadata does not update the feed"""
+
+        foreskrift1 = models.Myndighetsforeskrift.objects.get(
+            forfattningssamling__slug="exfs", arsutgava="2009", lopnummer="1")
+        entry = models.AtomEntry.get_for(foreskrift1)
+
+        with CaptureQueriesContext(connection) as queries:
+            generate_rdf_post_for(foreskrift1)
+            generate_atom_entry_for(foreskrift1, update_only=True)
+        self.assertFalse([q for q in queries.captured_queries
+                          if not q['sql'].startswith('SELECT')])
+        self.assertEqual(models.AtomEntry.get_for(foreskrift1).updated,
+                         entry.updated)
+
+        # Changing published metadata updates the entry
+        foreskrift1.sammanfattning = "Ny sammanfattning"
+        foreskrift1.save()
+        generate_rdf_post_for(foreskrift1)
+        generate_atom_entry_for(foreskrift1, update_only=True)
+        updated_entry = models.AtomEntry.get_for(foreskrift1)
+        self.assertGreater(updated_entry.updated, entry.updated)
+        self.assertEqual(updated_entry.published, entry.published)
+        self.assertIn("Ny sammanfattning", updated_entry.entry_xml)
+
+    def test_feed_not_modified(self):
+        """Unchanged feed is answered with 304 using the ETag"""
+
+        response = self.client.get('/feed/')
+        etag = response['ETag']
+        # The time of the latest entry is not moved by deletions
+        self.assertFalse(response.has_header('Last-Modified'))
+        response = self.client.get('/feed/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Deleting a document changes the feed
+        models.Myndighetsforeskrift.objects.get(
+            forfattningssamling__slug="exfs", arsutgava="2009",
+            lopnummer="2").delete()
+        response = self.client.get('/feed/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(
+            '/feed/', HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(parseString(response.content).
+                             getElementsByTagNameNS(NS_ATOM, 'entry')), 1)
+
+    def test_rdf_not_modified(self):
+        """RDF is answered with 304 when checksum matches"""
+
+        rdf_post = models.RDFPost.objects.get(slug="exfs/2009:1")
+        response = self.client.get('/publ/exfs/2009:1/rdf')
+        self.assertEqual(response['ETag'], '"%s"' % rdf_post.md5)
+        response = self.client.get('/publ/exfs/2009:1/rdf',
+                                   HTTP_IF_NONE_MATCH='"%s"' % rdf_post.md5)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/publ/exfs/2009:1/rdf',
+                                   HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
     def _get_parsed_feed(self, path):
         # Get Atom feed
         response = self.client.get(path)
@@ -362,6 +857,84 @@ class FeedTestCase(TestCase):
         return parseString(response.content)
 
 
+@override_settings(FST_FEED_PAGE_SIZE=2)
+class FeedPagingTestCase(TestCase):
+    """Test paged and archived Atom feed (RFC 5005)"""
+
+    fixtures = ['exempeldata.json']
+
+    def setUp(self):
+        self.docs = [models.Myndighetsforeskrift.objects.get(
+            forfattningssamling__slug="exfs", arsutgava="2009", lopnummer=nr)
+            for nr in ("1", "2", "3")]
+        for doc in self.docs:
+            generate_rdf_post_for(doc)
+            generate_atom_entry_for(doc)
+
+    def test_current_feed_links_to_archive(self):
+        """Subscription document only has entries after the archive"""
+
+        dom = self._get_parsed_feed('/feed/')
+        self.assertEquals(len(dom.getElementsByTagNameNS(NS_ATOM, 'entry')), 1)
+        self.assertFalse(dom.getElementsByTagNameNS(NS_ATOM_FH, 'complete'))
+        self.assertEqual(self._get_link(dom, 'prev-archive'),
+                         '/feed/archive/1/')
+
+    def test_archive_page(self):
+        """Full archive page has the oldest entries and is cacheable"""
+
+        self.client.get('/feed/')
+        response = self.client.get('/feed/archive/1/')
+        self.assertIn('max-age', response['Cache-Control'])
+        dom = parseString(response.content)
+        self.assertEquals(len(dom.getElementsByTagNameNS(NS_ATOM, 'entry')), 2)
+        self.assertEquals(len(dom.getElementsByTagNameNS(NS_ATOM_FH,
+                                                         'archive')), 1)
+        self.assertEqual(self._get_link(dom, 'current'), '/feed/')
+        self.assertEqual(self.client.get('/feed/archive/2/').status_code, 404)
+
+    def test_archive_is_frozen(self):
+        """Updating an archived document does not change the archive"""
+
+        self.client.get('/feed/')
+        archived = self.client.get('/feed/archive/1/').content
+        self.docs[0].sammanfattning = "Ny sammanfattning"
+        self.docs[0].save()
+        generate_atom_entry_for(self.docs[0])
+
+        # Updated entry fills the next page together with the third entry
+        dom = self._get_parsed_feed('/feed/')
+        self.assertFalse(dom.getElementsByTagNameNS(NS_ATOM, 'entry'))
+        self.assertEqual(self._get_link(dom, 'prev-archive'),
+                         '/feed/archive/2/')
+        self.assertEqual(self.client.get('/feed/archive/1/').content, archived)
+
+    def test_reading_does_not_freeze(self):
+        """Archive pages are frozen when entries are written, not read"""
+
+        self.assertEqual(models.FeedArchive.objects.count(), 1)
+        models.FeedArchive.objects.all().delete()
+        dom = self._get_parsed_feed('/feed/')
+        self.assertEqual(len(dom.getElementsByTagNameNS(NS_ATOM, 'entry')), 3)
+        self.assertEqual(models.FeedArchive.objects.count(), 0)
+
+        out = StringIO()
+        call_command('archive_feed', stdout=out)
+        self.assertIn("Froze 1 archive pages, latest is 1", out.getvalue())
+        dom = self._get_parsed_feed('/feed/')
+        self.assertEqual(len(dom.getElementsByTagNameNS(NS_ATOM, 'entry')), 1)
+
+    def _get_link(self, dom, rel):
+        for link in dom.getElementsByTagNameNS(NS_ATOM, 'link'):
+            if link.getAttribute('rel') == rel:
+                return link.getAttribute('href')
+
+    def _get_parsed_feed(self, path):
+        response = self.client.get(path)
+        self.failUnlessEqual(response.status_code, 200)
+        return parseString(response.content)
+
+
 class RDFTestCase(TestCase):
     """Test basic RDF functionality  """
 
@@ -426,6 +999,53 @@ class RDFTestCase(TestCase):
         ref = URIRef("/publ/exfs/2009:2", RINFO_BASE)
         self.assertTrue(list(graph.objects(ref, RPUBL.andrar)))
 
+    def test_serializers_match_rdflib(self):
+        """Verify that RDF/XML and N-Triples writers give the same graph
+        as rdflib for all document types"""
+
+        docs = [models.Myndighetsforeskrift.objects.get(pk=pk)
+                for pk in (1, 2, 3)]
+        docs.append(models.AllmannaRad.objects.get(pk=4))
+        docs.append(models.KonsolideradForeskrift.objects.get(pk=1))
+        for doc in docs:
+            description = doc.rdf_description()
+            expected = Graph().parse(
+                data=description.to_rdf().serialize(format='pretty-xml'))
+            rdfxml = Graph().parse(data=description.to_rdfxml())
+            ntriples = Graph().parse(data=description.to_ntriples(),
+                                     format='nt')
+            self.assertTrue(len(expected) > 5)
+            self.assertTrue(isomorphic(rdfxml, expected), doc)
+            self.assertTrue(isomorphic(ntriples, expected), doc)
+
+    def test_regenerate_rdf(self):
+        """Verify that only changed RDF posts are written"""
+
+        foreskrift = models.Myndighetsforeskrift.objects.get(pk=1)
+        generate_atom_entry_for(foreskrift)
+        out = StringIO()
+        call_command('regenerate_rdf', workers=1, dry_run=True, stdout=out)
+        self.assertIn("5 documents, 5 would be updated", out.getvalue())
+        self.assertNotEqual(models.RDFPost.get_for(foreskrift).data,
+                            foreskrift.to_rdfxml())
+
+        call_command('regenerate_rdf', workers=1, stdout=out)
+        self.assertEqual(models.RDFPost.get_for(foreskrift).data,
+                         foreskrift.to_rdfxml())
+        # Atom entry refers to the new RDF
+        entry = models.AtomEntry.get_for(foreskrift)
+        self.assertIn(models.RDFPost.get_for(foreskrift).md5,
+                      entry.entry_xml)
+
+        out = StringIO()
+        call_command('regenerate_rdf', workers=1, stdout=out)
+        self.assertIn("5 documents, 0 updated", out.getvalue())
+
+        out = StringIO()
+        call_command('regenerate_rdf', workers=1, collection="nofs",
+                     stdout=out)
+        self.assertIn("0 documents", out.getvalue())
+
     def _get_foreskrift_graph(self, fs_slug, arsutgava, lopnummer):
         return self._get_graph_for_type(models.Myndighetsforeskrift,
                                         fs_slug, arsutgava, lopnummer)
@@ -439,3 +1059,538 @@ class RDFTestCase(TestCase):
             forfattningssamling__slug=fs_slug,
             arsutgava=arsutgava, lopnummer=lopnummer)
         return Graph().parse(data=foreskrift.to_rdfxml())
+
+
+class ImportFeedTestCase(TestCase):
+    """Test fetching of feed entries in 'importfeed'"""
+
+    fixtures = ['exempeldata.json']
+
+    def setUp(self):
+        self.served_dir = tempfile.mkdtemp()
+        self.download_dir = tempfile.mkdtemp()
+        self.requests = []
+        self.connections = []
+        test = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                test.connections.append(self.client_address)
+                SimpleHTTPRequestHandler.setup(self)
+
+            def send_head(self):
+                test.requests.append(self.path)
+                return SimpleHTTPRequestHandler.send_head(self)
+
+            def log_message(self, *args):
+                pass
+
+        def handler(*args, **kwargs):
+            return Handler(*args, directory=self.served_dir, **kwargs)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base_url = "http://127.0.0.1:%s/" % self.server.server_port
+
+        fixture_dir = os.path.join(os.path.dirname(__file__),
+                                   'fixtures', 'foreskrift')
+        entries = []
+        for pk, pdf in ((1, 'EXFS_2009-1_Grund.pdf'),
+                        (2, 'EXFS_2009-2_Andring_omtryck.pdf')):
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=pk)
+            with open(os.path.join(self.served_dir, '%s.rdf' % pk), 'w') as f:
+                f.write(foreskrift.to_rdfxml())
+            shutil.copy(os.path.join(fixture_dir, pdf), self.served_dir)
+            with open(os.path.join(fixture_dir, pdf), 'rb') as f:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            entries.append(
+                '<entry><updated>2012-01-0%sT00:00:00Z</updated>'
+                '<link rel="alternate" type="application/rdf+xml" '
+                'href="%s.rdf"/><content type="application/pdf" src="%s" '
+                'le:md5="%s"/></entry>' % (pk, pk, pdf, md5))
+        with open(os.path.join(self.served_dir, 'feed.xml'), 'w') as f:
+            f.write('<feed xmlns="%s" xmlns:le="%s">%s</feed>' % (
+                NS_ATOM, NS_ATOMLE, "".join(reversed(entries))))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.served_dir)
+        shutil.rmtree(self.download_dir)
+
+    def _fetch(self):
+        command = importfeed.Command()
+        command.pool = importfeed.ConnectionPool()
+        command.download_dir = self.download_dir
+        command.workers = 2
+        entries = command.read_feed(self.base_url + "feed.xml")
+        return command.fetch_entries(entries)
+
+    def test_fetch_entries(self):
+        """Verify that entries are downloaded in feed order over reused
+        connections"""
+
+        records = self._fetch()
+        self.assertEqual([r['rdf_url'] for r in records],
+                         [self.base_url + "1.rdf", self.base_url + "2.rdf"])
+        for record in records:
+            with open(record['pdf_path'], 'rb') as f:
+                self.assertEqual(hashlib.md5(f.read()).hexdigest(),
+                                 record['pdf_md5'])
+            Graph().parse(record['rdf_path'], format='xml')
+        self.assertEqual(len(self.requests), 5)
+        self.assertTrue(len(self.connections) <= 3)
+
+    def test_resume(self):
+        """Verify that completed entries and matching PDFs are not fetched
+        again"""
+
+        os.rename(os.path.join(self.served_dir, '2.rdf'),
+                  os.path.join(self.served_dir, '2.rdf.tmp'))
+        self.assertRaises(CommandError, self._fetch)
+
+        os.rename(os.path.join(self.served_dir, '2.rdf.tmp'),
+                  os.path.join(self.served_dir, '2.rdf'))
+        self.requests[:] = []
+        records = self._fetch()
+        self.assertEqual(self.requests,
+                         ['/feed.xml', '/2.rdf',
+                          '/EXFS_2009-2_Andring_omtryck.pdf'])
+        self.assertEqual(len(records), 2)
+
+        # Nothing left to fetch
+        self.requests[:] = []
+        self._fetch()
+        self.assertEqual(self.requests, ['/feed.xml'])
+
+        # Without checkpoint, downloaded PDFs are still reused
+        os.remove(os.path.join(self.download_dir, 'checkpoint.jsonl'))
+        self.requests[:] = []
+        self._fetch()
+        self.assertEqual(sorted(self.requests),
+                         ['/1.rdf', '/2.rdf', '/feed.xml'])
+
+
+class BulkLoadTestCase(SimpleTestCase):
+    """Test loading of rows with 'bulkload'"""
+
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.executescript("""
+            CREATE TABLE samling (id integer PRIMARY KEY, titel text);
+            CREATE TABLE dokument (
+                id integer PRIMARY KEY,
+                samling_id integer REFERENCES samling (id),
+                titel text);
+            CREATE UNIQUE INDEX dokument_titel ON dokument (titel);
+            """)
+
+    def test_bulk_load(self):
+        """Verify that rows are loaded in any order and that indexes
+        are restored"""
+
+        data = {'dokument': [{'id': '1', 'samling_id': '1',
+                              'titel': "Föreskrift om 'citat'"},
+                             {'id': '2', 'samling_id': '1', 'titel': "2"},
+                             {'id': '3', 'titel': "3"}],
+                'samling': [{'id': 1, 'titel': "Exempel"}]}
+        violations = bulk_load(self.connection, data, defer_checks=True)
+        self.assertEqual(violations, [])
+        self.assertEqual(
+            self.connection.execute(
+                "SELECT titel FROM dokument WHERE id = 1").fetchone(),
+            ("Föreskrift om 'citat'",))
+        self.assertEqual(
+            self.connection.execute(
+                "SELECT count(*) FROM dokument WHERE samling_id IS NULL"
+            ).fetchone(), (1,))
+        self.assertRaises(
+            sqlite3.IntegrityError, self.connection.execute,
+            "INSERT INTO dokument (titel) VALUES ('2')")
+
+    def test_foreign_key_violations(self):
+        """Verify that rows referring to missing rows are reported"""
+
+        data = {'dokument': [{'id': 1, 'samling_id': 7, 'titel': "1"}]}
+        self.assertEqual(bulk_load(self.connection, data, defer_checks=True),
+                         [('dokument', 1, 'samling')])
+
+    def test_duplicate_rows(self):
+        """Verify that rows violating a unique index are reported"""
+
+        data = {'dokument': [{'id': 1, 'titel': "1"}, {'id': 2, 'titel': "1"}]}
+        with self.assertRaisesRegex(DuplicateRowsError,
+                                    r"2 rows in dokument with \(titel\)"):
+            bulk_load(self.connection, data, defer_checks=True)
+
+
+class TitleIndexTestCase(SimpleTestCase):
+    """Test lookup of SFS titles with 'titleindex'"""
+
+    def test_build_and_lookup(self):
+        """Verify that titles are read from N-Triples and kept on disk"""
+
+        lines = [
+            b'<http://rinfo.lagrummet.se/publ/sfs/1962:700> '
+            b'<http://purl.org/dc/terms/title> "Brottsbalk"@sv .\n',
+            b'<http://rinfo.lagrummet.se/publ/sfs/1962:700> '
+            b'<http://purl.org/dc/terms/identifier> "SFS 1962:700" .\n',
+            b'<http://rinfo.lagrummet.se/publ/sfs/1949:105> '
+            b'<http://purl.org/dc/terms/title> '
+            b'"Tryckfrihetsf\\u00F6rordning \\"TF\\"" .\n',
+        ]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'titles.sqlite')
+            TitleIndex.build(path, iter(lines))
+            index = TitleIndex(path)
+            self.assertEqual(index.get('1962:700'), "Brottsbalk")
+            self.assertEqual(index.get('1949:105'),
+                             u'Tryckfrihetsförordning "TF"')
+            self.assertEqual(index.get('1999:1'), None)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class FileStorageTestCase(TestCase):
+    """Test storing of uploaded files"""
+
+    fixtures = ['exempeldata.json']
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_checksums_computed_while_writing(self):
+        """Verify that checksums of uploaded files are stored on save"""
+
+        data = b"%PDF-1.4 test"
+        with self.settings(MEDIA_ROOT=self.media_root, FST_FILE_SHA256=True):
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=3)
+            upload = SimpleUploadedFile("ny.pdf", data)
+            foreskrift.content = upload
+            foreskrift.save()
+            self.assertEqual(
+                models.FSDokument.objects.get(pk=3).content_md5,
+                hashlib.md5(data).hexdigest())
+            self.assertEqual(upload.sha256, hashlib.sha256(data).hexdigest())
+            with open(os.path.join(self.media_root, "foreskrift/ny.pdf"),
+                      'rb') as f:
+                self.assertEqual(f.read(), data)
+
+            bilaga = models.Bilaga(foreskrift=foreskrift, titel="Bilaga",
+                                   file=SimpleUploadedFile("b.pdf", data))
+            bilaga.save()
+            self.assertEqual(bilaga.file_md5, hashlib.md5(data).hexdigest())
+
+    def test_checksums_computed_while_receiving(self):
+        """Verify that upload handlers compute checksums of received files"""
+
+        data = b"%PDF-1.4 " + b"x" * 100
+        with self.settings(MEDIA_ROOT=self.media_root, FST_FILE_SHA256=True,
+                           FILE_UPLOAD_MAX_MEMORY_SIZE=50):
+            for handler in (ChecksumMemoryFileUploadHandler(),
+                            ChecksumTemporaryFileUploadHandler()):
+                handler.handle_raw_input(None, {}, 50, None)
+                try:
+                    handler.new_file("file", "ny.pdf", "application/pdf",
+                                     len(data))
+                except StopFutureHandlers:
+                    pass
+                for start in range(0, len(data), 30):
+                    handler.receive_data_chunk(data[start:start + 30], start)
+                upload = handler.file_complete(len(data))
+                self.assertEqual(upload.md5, hashlib.md5(data).hexdigest())
+                self.assertEqual(upload.sha256,
+                                 hashlib.sha256(data).hexdigest())
+                upload.close()
+
+            # Checksums set on the upload are stored without reading it
+            upload = SimpleUploadedFile("b.pdf", data)
+            upload.md5 = "0" * 32
+            upload.sha256 = "0" * 64
+            bilaga = models.Bilaga(
+                foreskrift=models.Myndighetsforeskrift.objects.get(pk=3),
+                titel="Bilaga", file=upload)
+            bilaga.save()
+            self.assertEqual(bilaga.file_md5, "0" * 32)
+
+    def test_blobs(self):
+        """Verify that equal files are stored once and unused ones removed"""
+
+        data = b"%PDF-1.4 bilaga"
+        md5 = hashlib.md5(data).hexdigest()
+        blob_path = os.path.join(self.media_root, "blobs", md5[:2], md5)
+        with self.settings(MEDIA_ROOT=self.media_root, FST_FILE_BLOBS=True):
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=3)
+            for name in ("a.pdf", "b.pdf"):
+                models.Bilaga(foreskrift=foreskrift, titel=name,
+                              file=SimpleUploadedFile(name, data)).save()
+                self.assertTrue(os.path.samefile(
+                    os.path.join(self.media_root, "bilaga", name),
+                    blob_path))
+            self.assertEqual(os.stat(blob_path).st_nlink, 3)
+
+            # Replace one file, the blob is still referenced by the other
+            bilaga = models.Bilaga.objects.get(titel="a.pdf")
+            bilaga.file = SimpleUploadedFile("a.pdf", b"ny")
+            bilaga.save()
+            with open(os.path.join(self.media_root, "bilaga/a.pdf"),
+                      'rb') as f:
+                self.assertEqual(f.read(), b"ny")
+            out = StringIO()
+            call_command('gc_blobs', min_age=0, stdout=out)
+            self.assertIn("Removed 0 unreferenced blobs", out.getvalue())
+            self.assertTrue(os.path.exists(blob_path))
+
+            # Blobs no row refers to are removed with the names linked to
+            # them, unless changed recently
+            bilaga = models.Bilaga.objects.get(titel="b.pdf")
+            bilaga.file = SimpleUploadedFile("b.pdf", b"ny")
+            bilaga.save()
+            models.Bilaga(foreskrift=foreskrift, titel="c.pdf",
+                          file=SimpleUploadedFile("c.pdf", data)).save()
+            models.Bilaga.objects.filter(titel="c.pdf").delete()
+            out = StringIO()
+            call_command('gc_blobs', stdout=out)
+            self.assertIn("Removed 0 unreferenced blobs", out.getvalue())
+            out = StringIO()
+            call_command('gc_blobs', min_age=0, stdout=out)
+            self.assertIn("Removed 1 unreferenced blobs", out.getvalue())
+            self.assertFalse(os.path.exists(blob_path))
+            self.assertFalse(os.path.exists(
+                os.path.join(self.media_root, "bilaga/c.pdf")))
+            self.assertTrue(os.path.exists(
+                os.path.join(self.media_root, "bilaga/b.pdf")))
+
+            # A missing blob is stored again
+            md5 = hashlib.md5(b"ny").hexdigest()
+            blob_path = os.path.join(self.media_root, "blobs", md5[:2], md5)
+            os.remove(blob_path)
+            models.Bilaga(foreskrift=foreskrift, titel="d.pdf",
+                          file=SimpleUploadedFile("d.pdf", b"ny")).save()
+            with open(os.path.join(self.media_root, "bilaga/d.pdf"),
+                      'rb') as f:
+                self.assertEqual(f.read(), b"ny")
+            self.assertTrue(os.path.samefile(
+                os.path.join(self.media_root, "bilaga/d.pdf"), blob_path))
+
+    def test_shared_name(self):
+        """Verify that an upload does not replace the file of another row"""
+
+        data = b"%PDF-1.4 a"
+        for blobs in (False, True):
+            with self.settings(MEDIA_ROOT=self.media_root,
+                               FST_FILE_BLOBS=blobs):
+                foreskrift = models.Myndighetsforeskrift.objects.get(pk=3)
+                first = models.Bilaga.objects.create(
+                    foreskrift=foreskrift, titel="a",
+                    file=SimpleUploadedFile("a.pdf", data))
+                second = models.Bilaga.objects.create(
+                    foreskrift=foreskrift, titel="b",
+                    file=SimpleUploadedFile("a.pdf", b"%PDF-1.4 b"))
+                self.assertNotEqual(second.file.name, first.file.name)
+                first = models.Bilaga.objects.get(pk=first.pk)
+                self.assertEqual(first.file_md5, hashlib.md5(data).hexdigest())
+                with first.file.storage.open(first.file.name) as f:
+                    self.assertEqual(f.read(), data)
+
+                # The file of the row itself is replaced
+                first.file = SimpleUploadedFile("a.pdf", b"%PDF-1.4 c")
+                first.save()
+                self.assertEqual(first.file.name, "bilaga/a.pdf")
+                with first.file.storage.open(first.file.name) as f:
+                    self.assertEqual(f.read(), b"%PDF-1.4 c")
+                models.Bilaga.objects.filter(
+                    pk__in=[first.pk, second.pk]).delete()
+
+
+class BlobDeletionTestCase(TransactionTestCase):
+    """Test removal of stored files when rows are deleted"""
+
+    fixtures = ['exempeldata.json']
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_delete_removes_link(self):
+        """Verify that the file name of a deleted row is removed"""
+
+        with self.settings(MEDIA_ROOT=self.media_root, FST_FILE_BLOBS=True):
+            foreskrift = models.Myndighetsforeskrift.objects.get(pk=3)
+            bilagor = [models.Bilaga.objects.create(
+                foreskrift=foreskrift, titel="a",
+                file=SimpleUploadedFile("a.pdf", b"%PDF-1.4 a"))]
+            # Uploads don't share names, but older rows may
+            bilagor.append(models.Bilaga.objects.create(
+                foreskrift=foreskrift, titel="b", file="bilaga/a.pdf",
+                file_md5=bilagor[0].file_md5))
+            path = os.path.join(self.media_root, "bilaga/a.pdf")
+            # Kept while another row refers to the name
+            bilagor[0].delete()
+            self.assertTrue(os.path.exists(path))
+            bilagor[1].delete()
+            self.assertFalse(os.path.exists(path))
+
+
+class LRUMemoryCacheTestCase(SimpleTestCase):
+    """Test the bounded in-memory cache backend"""
+
+    def test_eviction(self):
+        """Verify that least recently used entries are evicted"""
+
+        cache = LRUMemoryCache('test_eviction', {
+            'TIMEOUT': None, 'OPTIONS': {'MAX_ENTRIES': 2}})
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'],
+                          stats['entries']), (3, 1, 1, 2))
+        self.assertEqual(stats['hit_rate'], 0.75)
+
+        cache = LRUMemoryCache('test_size', {
+            'TIMEOUT': None, 'OPTIONS': {'MAX_SIZE': 1000}})
+        cache.set('a', b"x" * 600)
+        cache.set('b', b"y" * 600)
+        self.assertFalse(cache.has_key('a'))
+        self.assertTrue(cache.has_key('b'))
+        self.assertLessEqual(cache.stats()['size'], 1000)
+        cache.delete('b')
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+class DokumentDeliveryTestCase(TestCase):
+    """Test delivery of uploaded files below '/dokument/'"""
+
+    fixtures = ['exempeldata.json']
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.data = b"%PDF-1.4 test"
+        for name in ("foreskrift/EXFS_2009-1_Grund.pdf",
+                     "foreskrift/EXFS_2009-2_Andring_omtryck.pdf"):
+            os.makedirs(os.path.join(self.media_root, os.path.dirname(name)),
+                        exist_ok=True)
+            with open(os.path.join(self.media_root, name), 'wb') as f:
+                f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_serve_file(self):
+        """Verify that files of published documents are sent by Django"""
+
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.get(
+                '/dokument/foreskrift/EXFS_2009-1_Grund.pdf')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), self.data)
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+            self.assertEqual(response['Content-Length'],
+                             str(len(self.data)))
+            self.assertEqual(response['ETag'],
+                             '"5c2c3fc272e57cb1f1c5d9d3d1aeec3b"')
+
+            response = self.client.get(
+                '/dokument/foreskrift/EXFS_2009-1_Grund.pdf',
+                HTTP_IF_NONE_MATCH='"5c2c3fc272e57cb1f1c5d9d3d1aeec3b"')
+            self.assertEqual(response.status_code, 304)
+
+    @override_settings(
+        FST_FILE_DELIVERY='fst_web.fs_doc.delivery.x_accel_redirect')
+    def test_x_accel_redirect(self):
+        """Verify that files are handed to nginx with X-Accel-Redirect"""
+
+        response = self.client.get(
+            '/dokument/foreskrift/EXFS_2009-1_Grund.pdf')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/dokument/foreskrift/EXFS_2009-1_Grund.pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['ETag'],
+                         '"5c2c3fc272e57cb1f1c5d9d3d1aeec3b"')
+        self.assertEqual(response.content, b"")
+
+    def test_unpublished_requires_staff(self):
+        """Verify that files of unpublished documents are only for staff"""
+
+        path = '/dokument/foreskrift/EXFS_2009-2_Andring_omtryck.pdf'
+        with self.settings(MEDIA_ROOT=self.media_root):
+            self.assertEqual(self.client.get(path).status_code, 404)
+            self.assertEqual(
+                self.client.get('/dokument/foreskrift/okand.pdf').status_code,
+                404)
+            self.client.login(username='editor', password='editor')
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('private', response['Cache-Control'])
+
+    def test_byte_ranges(self):
+        """Verify that byte ranges of files are sent as partial content"""
+
+        path = '/dokument/foreskrift/EXFS_2009-1_Grund.pdf'
+        etag = '"5c2c3fc272e57cb1f1c5d9d3d1aeec3b"'
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.get(path, HTTP_RANGE='bytes=5-7')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b"".join(response.streaming_content), b"1.4")
+            self.assertEqual(response['Content-Range'], 'bytes 5-7/13')
+            self.assertEqual(response['Content-Length'], '3')
+
+            response = self.client.get(path, HTTP_RANGE='bytes=-4')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b"".join(response.streaming_content), b"test")
+
+            response = self.client.get(path, HTTP_RANGE='bytes=9-',
+                                       HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b"".join(response.streaming_content), b"test")
+
+            # Range of another version of the file
+            response = self.client.get(path, HTTP_RANGE='bytes=9-',
+                                       HTTP_IF_RANGE='"ej-samma"')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), self.data)
+
+            response = self.client.get(path, HTTP_RANGE='bytes=13-')
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], 'bytes */13')
+
+    def test_if_modified_since(self):
+        """Verify that unchanged files are not sent again"""
+
+        path = '/dokument/foreskrift/EXFS_2009-1_Grund.pdf'
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.get(path)
+            response = self.client.get(
+                path, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_streamed_in_chunks(self):
+        """Verify that large files are read in fixed size chunks"""
+
+        data = os.urandom(150000)
+        with open(os.path.join(self.media_root,
+                               "foreskrift/EXFS_2009-1_Grund.pdf"), 'wb') as f:
+            f.write(data)
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.get(
+                '/dokument/foreskrift/EXFS_2009-1_Grund.pdf')
+            chunks = list(response.streaming_content)
+        self.assertEqual(b"".join(chunks), data)
+        self.assertEqual([len(chunk) for chunk in chunks],
+                         [64 * 1024, 64 * 1024, 150000 - 128 * 1024])
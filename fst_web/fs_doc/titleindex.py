@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Lookup of SFS titles by SFS number.
+
+The titles are read from an N-Triples dump (such as the one published by
+lagen.nu) line by line, and stored in an SQLite file that can be reused
+by later imports.
+"""
+import os
+import re
+import sqlite3
+
+SFS_BASE = "http://rinfo.lagrummet.se/publ/sfs/"
+DCT_TITLE = "http://purl.org/dc/terms/title"
+
+TITLE_TRIPLE = re.compile(
+    r'^<%s([^>]+)>\s+<%s>\s+"((?:[^"\\]|\\.)*)"' % (
+        re.escape(SFS_BASE), re.escape(DCT_TITLE)))
+ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f',
+           '"': '"', "'": "'", '\\': '\\'}
+
+
+def unescape(literal):
+    """Return value of an N-Triples string literal"""
+
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] in 'uU':
+            return chr(int(escape[1:], 16))
+        return ESCAPES.get(escape, escape)
+    return ESCAPE.sub(replace, literal)
+
+
+def parse_titles(lines):
+    """Generate (sfsnr, title) from N-Triples lines (str or bytes)"""
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        match = TITLE_TRIPLE.match(line)
+        if match:
+            yield match.group(1), unescape(match.group(2))
+
+
+class TitleIndex(object):
+    """SFS titles stored in an SQLite file"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+
+    @classmethod
+    def build(cls, path, lines):
+        """Create index at path from N-Triples lines.
+
+        The index is written to a temporary file which is renamed when
+        complete, so an interrupted build is never used. The first title
+        of an SFS number is kept.
+        """
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        connection = sqlite3.connect(tmp_path)
+        with connection:
+            connection.execute(
+                "CREATE TABLE titel (sfsnr text PRIMARY KEY, titel text)")
+            connection.executemany(
+                "INSERT OR IGNORE INTO titel (sfsnr, titel) VALUES (?, ?)",
+                parse_titles(lines))
+        connection.close()
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def get(self, sfsnr):
+        """Return title of sfsnr, or None if not found"""
+        row = self.connection.execute(
+            "SELECT titel FROM titel WHERE sfsnr = ?", (sfsnr,)).fetchone()
+        return row[0] if row else None
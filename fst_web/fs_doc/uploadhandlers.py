@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Upload handlers computing checksums of uploaded files.
+
+The checksums are computed from the chunks as they are received, and set
+as 'md5' (and 'sha256' if 'FST_FILE_SHA256' is set) on the uploaded file,
+so 'OverwritingStorage' does not read the file again when storing it.
+"""
+
+import hashlib
+from django.conf import settings
+from django.core.files.uploadhandler import MemoryFileUploadHandler
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+
+def new_checksums():
+    """Return list of (attribute name, hash object) to compute for a file"""
+
+    checksums = [('md5', hashlib.md5())]
+    if settings.FST_FILE_SHA256:
+        checksums.append(('sha256', hashlib.sha256()))
+    return checksums
+
+
+def has_checksums(content):
+    """Return True if all checksums are already set on 'content'"""
+
+    return all(getattr(content, name, None)
+               for name, checksum in new_checksums())
+
+
+class ChecksumUploadHandlerMixin(object):
+    """Compute checksums of the chunks a handler keeps of a file"""
+
+    def new_file(self, *args, **kwargs):
+        # Set first, the memory handler raises StopFutureHandlers
+        self.checksums = new_checksums()
+        super(ChecksumUploadHandlerMixin, self).new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super(ChecksumUploadHandlerMixin, self).receive_data_chunk(
+            raw_data, start)
+        if data is None:
+            # The chunk is kept by this handler, not passed on
+            for name, checksum in self.checksums:
+                checksum.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        uploaded = super(ChecksumUploadHandlerMixin, self).file_complete(
+            file_size)
+        if uploaded is not None:
+            for name, checksum in self.checksums:
+                setattr(uploaded, name, checksum.hexdigest())
+        return uploaded
+
+
+class ChecksumMemoryFileUploadHandler(ChecksumUploadHandlerMixin,
+                                      MemoryFileUploadHandler):
+    pass
+
+
+class ChecksumTemporaryFileUploadHandler(ChecksumUploadHandlerMixin,
+                                         TemporaryFileUploadHandler):
+    pass
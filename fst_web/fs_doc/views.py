@@ -1,14 +1,35 @@
 # -*- coding: utf-8 -*-
 """View code for displaying different representations of FST data"""
 
+import hashlib
+import os
+from datetime import datetime
+from itertools import islice
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import StreamingHttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
+from django.template import loader
+from django.utils.cache import patch_cache_control
 from django.utils.feedgenerator import rfc3339_date
+from django.views.decorators.http import condition
+from fst_web.fs_doc import delivery
+from fst_web.fs_doc.cache import cached_page
 from fst_web.fs_doc.models import KonsolideradForeskrift, AllmannaRad
 from fst_web.fs_doc.models import Myndighetsforeskrift
-from fst_web.fs_doc.models import AtomEntry, RDFPost
+from fst_web.fs_doc.models import AtomEntry, FeedArchive, RDFPost
+from fst_web.fs_doc.models import entries_after_archive, feed_context
+from fst_web.fs_doc.models import prefetch_entry_documents
+
+ATOM_CONTENT_TYPE = "application/atom+xml; charset=utf-8"
+
+# Archive pages never change, so clients may cache them for a year
+FEED_ARCHIVE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Number of entries read at a time when streaming the feed
+FEED_STREAM_CHUNK_SIZE = 100
 
 
 def _response(request, template, context):
@@ -26,6 +47,107 @@ def index(request):
     return HttpResponseRedirect(reverse('admin:index'))
 
 
+def _rdf_etag(request, fs_dokument_slug):
+    """Use checksum of stored RDF as ETag"""
+
+    return RDFPost.objects.filter(slug=fs_dokument_slug).values_list(
+        'md5', flat=True).first()
+
+
+def _feed_validators(request):
+    """Return ETag and time of the latest entry for the feed.
+
+    Number of entries and highest id are included in the ETag, so that
+    deleted and re-created entries also change it, and the latest change
+    of entry content, so that rebuilt entries do too. No Last-Modified is
+    sent, since the time of the latest entry does not change when an
+    entry is deleted. Computed with one query and kept on the request.
+    """
+
+    if not hasattr(request, '_fst_feed_validators'):
+        stats = AtomEntry.objects.aggregate(
+            last_updated=Max('updated'), last_changed=Max('xml_changed'),
+            count=Count('id'), last_id=Max('id'))
+        etag = "%s-%s-%s-%s-%s" % (
+            stats['last_updated'].isoformat()
+            if stats['last_updated'] else "",
+            stats['last_changed'].isoformat()
+            if stats['last_changed'] else "",
+            stats['count'], stats['last_id'], settings.FST_FEED_PAGE_SIZE)
+        request._fst_feed_validators = (
+            hashlib.md5(etag.encode('utf-8')).hexdigest(),
+            stats['last_updated'])
+    return request._fst_feed_validators
+
+
+def _feed_etag(request):
+    return _feed_validators(request)[0]
+
+
+def _stored_file(request, path):
+    """Return 'StoredFile' for 'path' if the user may download it.
+
+    Files of unpublished documents are only available to staff. Kept on
+    the request, since it is needed both for the ETag and the response.
+    """
+
+    if not hasattr(request, '_fst_stored_file'):
+        stored = delivery.find_file(path)
+        if stored and not stored.is_published and \
+                not request.user.is_staff:
+            stored = None
+        request._fst_stored_file = stored
+    return request._fst_stored_file
+
+
+def _dokument_etag(request, path):
+    """Use stored checksum of the file as ETag"""
+
+    stored = _stored_file(request, path)
+    if stored and stored.md5:
+        return stored.md5
+    return None
+
+
+def _dokument_last_modified(request, path):
+    """Use modification time of the stored file as time of last change"""
+
+    stored = _stored_file(request, path)
+    if not stored:
+        return None
+    try:
+        mtime = os.path.getmtime(delivery.file_path(stored))
+    except OSError:
+        return None
+    return datetime.utcfromtimestamp(mtime)
+
+
+def _feed_archive_etag(request, number):
+    return FeedArchive.objects.filter(number=number).values_list(
+        'md5', flat=True).first()
+
+
+@condition(etag_func=_dokument_etag,
+           last_modified_func=_dokument_last_modified)
+def dokument(request, path):
+    """Deliver uploaded file of a document
+
+    If-None-Match is evaluated against the stored md5 of the file and
+    If-Modified-Since against its modification time, before the file is
+    handed to the delivery backend.
+    """
+
+    stored = _stored_file(request, path)
+    if stored is None:
+        raise Http404
+    response = delivery.deliver(request, stored)
+    if not stored.is_published:
+        patch_cache_control(response, private=True)
+    return response
+
+
+@cached_page('fs_dokument_rdf')
+@condition(etag_func=_rdf_etag)
 def fs_dokument_rdf(request, fs_dokument_slug):
     """Display RDF representation of document"""
 
@@ -34,6 +156,7 @@ def fs_dokument_rdf(request, fs_dokument_slug):
         rdf_post.data, content_type="application/rdf+xml;charset=utf-8")
 
 
+@cached_page('fs_dokument')
 def fs_dokument(request, fs_dokument_slug):
     """Display custom HTML view of document
 
@@ -43,39 +166,97 @@ def fs_dokument(request, fs_dokument_slug):
 
     rdf_post = get_object_or_404(RDFPost, slug=fs_dokument_slug)
     document_content = rdf_post.content_object
-    if isinstance(document_content, AllmannaRad):
-        return _response(
-            request,
-            'allmanna_rad.html',
-            dict(doc=document_content))
-    elif isinstance(document_content, Myndighetsforeskrift):
-        return _response(
-            request,
-            'foreskrift.html',
-            dict(doc=document_content))
-    elif isinstance(document_content, KonsolideradForeskrift):
+    template = fs_dokument_template(document_content)
+    if template:
         return _response(
             request,
-            'konsoliderad_foreskrift.html',
+            template,
             dict(doc=document_content))
-    else:
-        pass
 
 
+def fs_dokument_template(document):
+    """Return name of HTML template for 'document', or None"""
+
+    if isinstance(document, AllmannaRad):
+        return 'allmanna_rad.html'
+    elif isinstance(document, Myndighetsforeskrift):
+        return 'foreskrift.html'
+    elif isinstance(document, KonsolideradForeskrift):
+        return 'konsoliderad_foreskrift.html'
+    return None
+
+
+def _stream_feed(entries, context):
+    """Generate feed document piece by piece.
+
+    The feed template is rendered without entries and split into header
+    and footer. Entries are read from the database in chunks in between,
+    so memory use does not depend on the size of the feed.
+    """
+
+    header, footer = loader.render_to_string(
+        'atomfeed.xml', context).rsplit('</feed>', 1)
+    yield header
+    entries = entries.iterator()
+    while True:
+        chunk = list(islice(entries, FEED_STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        prefetch_entry_documents(
+            [entry for entry in chunk if not entry.entry_xml])
+        for entry in chunk:
+            yield entry.to_entryxml() + "\n\n    "
+    yield '</feed>' + footer
+
+
+@cached_page('atomfeed')
+@condition(etag_func=_feed_etag)
 def atomfeed(request):
-    """ Display Atom Feed representing activities in document collection """
-
-    entries = AtomEntry.objects.order_by("-updated")
-    context = {
-        'entries': AtomEntry.objects.order_by("-updated"),
-        'last_updated': rfc3339_date(entries[0].updated) if entries else "",
-        'feed_id': settings.FST_DATASET_URI,
-        'feed_title': settings.FST_DATASET_TITLE,
-        'feed_contact_name': settings.FST_ORG_CONTACT_NAME,
-        'feed_contact_url': settings.FST_ORG_CONTACT_URL,
-        'feed_contact_email': settings.FST_ORG_CONTACT_EMAIL,
-        'fst_instance_url': settings.FST_INSTANCE_URL,
-    }
+    """ Display Atom Feed representing activities in document collection
+
+    If 'FST_FEED_PAGE_SIZE' is set, only entries updated since the latest
+    archive page are included, with a link to the archive (RFC 5005).
+    Otherwise the complete feed is displayed. Archive pages are frozen
+    when entries are written, never here.
+    """
+
+    extra = {}
+    if settings.FST_FEED_PAGE_SIZE:
+        archive = FeedArchive.latest()
+        entries = entries_after_archive(archive)
+        if archive:
+            extra['prev_archive_path'] = reverse('atomfeed_archive',
+                                                 args=[archive.number])
+            if not entries.exists():
+                extra['last_updated'] = rfc3339_date(archive.last_updated)
+    else:
+        entries = AtomEntry.objects.all()
+    entries = entries.order_by("-updated", "-id")
+
+    if settings.FST_FEED_STREAMING:
+        # Time of the latest entry, as in a feed that is not streamed
+        last_updated = _feed_validators(request)[1]
+        if last_updated:
+            extra.setdefault('last_updated', rfc3339_date(last_updated))
+        return StreamingHttpResponse(
+            _stream_feed(entries, feed_context([], **extra)),
+            content_type=ATOM_CONTENT_TYPE)
+
+    entries = list(entries)
+    # Entries without stored XML are rendered, load their documents in bulk
+    prefetch_entry_documents(
+        [entry for entry in entries if not entry.entry_xml])
+    context = feed_context(entries, **extra)
     return HttpResponse(
         _response(request, 'atomfeed.xml', context),
-        content_type="application/atom+xml; charset=utf-8")
+        content_type=ATOM_CONTENT_TYPE)
+
+
+@condition(etag_func=_feed_archive_etag)
+def atomfeed_archive(request, number):
+    """Display frozen archive page of the Atom feed"""
+
+    archive = get_object_or_404(FeedArchive, number=number)
+    response = HttpResponse(archive.data, content_type=ATOM_CONTENT_TYPE)
+    patch_cache_control(response, public=True, max_age=FEED_ARCHIVE_MAX_AGE)
+    return response
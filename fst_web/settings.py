@@ -135,6 +135,63 @@ PASSWORD_HASHERS = (
     'django.contrib.auth.hashers.CryptPasswordHasher',
 )
 
+# Number of entries in each archive page of the Atom feed (RFC 5005).
+# With the default value None, the feed is published as one complete feed.
+# Archive pages are frozen, so a deleted document stays in the page it was
+# archived in. No deleted-entry is written, as FST has no tombstones: use
+# the complete feed when deletions must be seen by readers.
+FST_FEED_PAGE_SIZE = None
+
+# Stream the Atom feed to the client entry by entry, instead of building
+# the whole document in memory first.
+FST_FEED_STREAMING = False
+
+# Also compute SHA-256 checksums of uploaded files while they are stored.
+FST_FILE_SHA256 = False
+
+# Compute the checksums of uploaded files while they are received, so they
+# are not read again when stored.
+FILE_UPLOAD_HANDLERS = [
+    'fst_web.fs_doc.uploadhandlers.ChecksumMemoryFileUploadHandler',
+    'fst_web.fs_doc.uploadhandlers.ChecksumTemporaryFileUploadHandler',
+]
+
+# Store each uploaded file once per md5 below MEDIA_ROOT/blobs, and make
+# the file names of documents hard links to it. Unreferenced files are
+# removed with 'manage.py gc_blobs'. Requires a file system with hard links.
+FST_FILE_BLOBS = False
+
+# Backend delivering uploaded files below '/dokument/'. In production, use
+# 'fst_web.fs_doc.delivery.x_accel_redirect' to let nginx send the files
+# from the internal location 'FST_FILE_DELIVERY_INTERNAL_URL'.
+FST_FILE_DELIVERY = 'fst_web.fs_doc.delivery.serve_file'
+FST_FILE_DELIVERY_INTERNAL_URL = '/protected/dokument/'
+
+# Cache of the public views of documents and the Atom feed. Responses are
+# removed when documents, or documents they link to, are published or
+# deleted, not after a timeout.
+# Off by default. The memory cache 'fst_pages' is kept per process, so
+# only set FST_PAGE_CACHE to 'fst_pages' when running a single worker
+# process. With several (see deploy/gunicorn), configure 'fst_pages' in
+# local settings with a cache shared by all of them, such as
+# 'django.core.cache.backends.filebased.FileBasedCache', so that removed
+# responses are not served by the other processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fst_pages': {
+        'BACKEND': 'fst_web.fs_doc.cache.LRUMemoryCache',
+        'LOCATION': 'fst_pages',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+            'MAX_SIZE': 64 * 1024 * 1024,  # Bytes
+        },
+    },
+}
+FST_PAGE_CACHE = None
+
 # Look for instance-specific settings
 # TODO - declare specific imports
 try:
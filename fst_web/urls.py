@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
-from django.conf import settings
 from django.contrib import admin
 from django.conf.urls import url, include
 from django.views.generic.base import TemplateView, RedirectView
-from django.views.static import serve
 from fst_web.fs_doc.views import index, fs_dokument_rdf, fs_dokument, atomfeed
+from fst_web.fs_doc.views import dokument
+from fst_web.fs_doc.views import atomfeed_archive
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 
 
@@ -18,11 +18,10 @@ class TextPlainView(TemplateView):
 admin.autodiscover()
 # URL-routing
 urlpatterns = [
-    # Get files from server
-    url
-    (r'^dokument/(?P<path>.*)$',
-     serve,
-     {'document_root': settings.MEDIA_ROOT.replace('\\', '/')}),
+    # Get uploaded files of documents
+    url(r'^dokument/(?P<path>.*)$',
+        dokument,
+        name='dokument'),
 
     # Display start page ("/")
     url(r'^$',
@@ -44,6 +43,11 @@ urlpatterns = [
         atomfeed,
         name='atomfeed'),
 
+    # Display frozen archive page of Atom feed
+    url(r'^feed/archive/(?P<number>\d+)/$',
+        atomfeed_archive,
+        name='atomfeed_archive'),
+
     # Tell web crawlers how to behave via robots.txt
     url(r'^robots\.txt$', TemplateView, {
         'template': 'robots.txt',
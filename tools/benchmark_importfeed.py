@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Measure how 'importfeed' scales with the number of feed entries.
+
+    Synthetic documents are added with 'Command.add_graph', the same way
+    as entries read from a feed, but without any network access. Each
+    document amends an earlier one, so lookups of related documents,
+    collections and authorities are exercised for every entry.
+
+    Usage: python tools/benchmark_importfeed.py [SIZE ...]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fst_web.settings")
+
+import django
+django.setup()
+
+from rdflib import Graph, Literal, RDF, URIRef
+from fst_web.fs_doc.management.commands.importfeed import Command, DCT, \
+    RPUBL
+
+RINFO_BASE = "http://rinfo.lagrummet.se"
+SIZES = (1000, 5000, 10000, 50000)
+COLLECTIONS = 20
+AUTHORITIES = 50
+
+
+def synthetic_graph(n):
+    """Return RDF for the n:th synthetic 'Myndighetsforeskrift'"""
+    slug = "fs%s" % (n % COLLECTIONS)
+    arsutgava = str(1990 + n // 1000)
+    lopnummer = str(n % 1000 + 1)
+    ref = URIRef("%s/publ/%s/%s:%s" % (RINFO_BASE, slug, arsutgava, lopnummer))
+    org = URIRef("%s/org/myndighet_%s" % (RINFO_BASE, n % AUTHORITIES))
+    g = Graph()
+    g.add((ref, RDF.type, RPUBL.Myndighetsforeskrift))
+    g.add((ref, DCT.title, Literal("Föreskrift %s" % n, lang='sv')))
+    g.add((ref, RPUBL.forfattningssamling,
+           URIRef("%s/serie/fs/%s" % (RINFO_BASE, slug))))
+    g.add((ref, RPUBL.arsutgava, Literal(arsutgava)))
+    g.add((ref, RPUBL.lopnummer, Literal(lopnummer)))
+    g.add((ref, RPUBL.beslutsdatum, Literal("%s-01-01" % arsutgava)))
+    g.add((ref, RPUBL.utkomFranTryck, Literal("%s-01-02" % arsutgava)))
+    g.add((ref, RPUBL.ikrafttradandedatum, Literal("%s-02-01" % arsutgava)))
+    g.add((ref, RPUBL.beslutadAv, org))
+    g.add((ref, DCT.publisher, org))
+    if n >= COLLECTIONS:
+        # Amend the previous document in the same collection
+        m = n - COLLECTIONS
+        g.add((ref, RPUBL.andrar, URIRef("%s/publ/%s/%s:%s" % (
+            RINFO_BASE, slug, 1990 + m // 1000, m % 1000 + 1))))
+    return g
+
+
+def run(size, pdf_path):
+    """Return seconds spent adding 'size' entries"""
+    command = Command()
+    elapsed = 0.0
+    for n in range(size):
+        g = synthetic_graph(n)
+        start = time.perf_counter()
+        command.add_graph(g, pdf_path, 'd41d8cd98f00b204e9800998ecf8427e')
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def main(sizes):
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    try:
+        # PDFs are copied relative to the current directory
+        os.chdir(workdir)
+        pdf_path = os.path.join(workdir, 'empty.pdf')
+        open(pdf_path, 'wb').close()
+        print("%10s %12s %16s" % ("entries", "seconds", "ms per entry"))
+        for size in sizes:
+            elapsed = run(size, pdf_path)
+            print("%10s %12.2f %16.3f" % (size, elapsed,
+                                          1000 * elapsed / size))
+            shutil.rmtree(os.path.join(workdir, 'foreskrift'))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
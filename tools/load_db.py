@@ -5,45 +5,15 @@
     Currently contains hardcoded sample data for testing.
 """
 
+import ast
+import os
+import shutil
 import sys
 import sqlite3
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-def get_insert_string(row):
-    """ Build SQL string for fieldnames and values.
-
-    Parameter 'row' is a dictionary, so we must keep key/value combinations
-    together when constructing the string.
-    """
-    fields = "("
-    values = " VALUES("
-    for key, val in row.items():
-        fields = fields + key + ", "
-        if type(val) == int:
-            val = str(val)
-        values = values + "'" + val + "'" + ", "
-    fields = fields[:-2] + ")"
-    values = values[:-2] + ")"
-    return fields + values
-
-
-def fill_table(table_name, data, db_connection):
-    """Insert records in SQlite using a list of dictionaries """
-    print "Filling table %s" % table_name
-    for row in data[table_name]:
-        print "   record"
-        fill_record(table_name, row, db_connection)
-
-
-def fill_record(table_name, row, db_connection):
-    """Insert record in SQlite using a Python dictionary """
-    cursor = db_connection.cursor()
-    insert_statement = "INSERT INTO %s " % table_name
-    insert_data = get_insert_string(row)
-    sql = insert_statement + insert_data
-    print sql
-    cursor.execute(sql)
-    db_connection.commit()
+from fst_web.fs_doc.bulkload import bulk_load
 
 
 def main(indatafile, db_path):
@@ -54,35 +24,25 @@ def main(indatafile, db_path):
     """
 
     # db_path = "fst_no_docs.db"
-    print "copying fst_no_docs.db to %s" % db_path
-    import shutil
+    print("copying fst_no_docs.db to %s" % db_path)
     shutil.copy2("fst_no_docs.db", db_path)
     db_connection = sqlite3.connect(db_path)
-    db_connection.text_factory = str  # bugger 8-bit bytestrings
-
-    try:
-        data = eval(open(indatafile).read())
-        print "loaded indata, %s top-level keys" % len(data)
 
-        # With all ID:s in place, we can fill the table in any order
-        for table in data.keys():
-            fill_table(table, data, db_connection)
-        # fill_table('fs_doc_fsdokument', data, db_connection)
-        # fill_table('fs_doc_allmannarad', data, db_connection)
-        # fill_table('fs_doc_myndighetsforeskrift', data, db_connection)
-        # fill_table('fs_doc_Myndighet', data, db_connection)
-        # fill_table('fs_doc_Forfattningssamling', data, db_connection)
+    with open(indatafile) as f:
+        data = ast.literal_eval(f.read())
+    print("loaded indata, %s top-level keys" % len(data))
 
-    except:
-        # exc_type, exc_value, ex_tb = sys.exc_info()
-        # print exc_type, exc_value
-        # traceback.print_stack()
-        raise
+    # With all ID:s in place, we can fill the tables in any order
+    violations = bulk_load(db_connection, data, defer_checks=True, log=print)
+    for table, rowid, parent in violations:
+        print("WARNING: %s row %s refers to missing %s" % (table, rowid,
+                                                           parent))
+    db_connection.close()
 
 
 if __name__ == '__main__':
     if len(sys.argv) != 3:
-        print("Usage: %s <indatafile> <dbpath>")
+        print("Usage: %s <indatafile> <dbpath>" % sys.argv[0])
     else:
         indata = sys.argv[1]
         sqllite_file = sys.argv[2]
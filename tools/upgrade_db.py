@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+""" Upgrade an SQLite database of FST to the schema of the current models.
+
+    FST has no migrations of its own. The database is therefore created
+    again from the models, and all rows of the old database are copied
+    into it. Columns added since the old database was created get the
+    default value of their model field, and stored identifiers of the
+    documents are filled in. The old file is replaced when done.
+
+    Used for 'tools/fst_no_docs.db' and the demo database, and for
+    instance databases created before the current models.
+
+    Usage: python tools/upgrade_db.py <dbpath>
+"""
+
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fst_web.settings")
+
+from django.conf import settings
+
+from fst_web.fs_doc.bulkload import DuplicateRowsError, check_duplicates
+from fst_web.fs_doc.bulkload import get_unique_columns, quote_name
+
+
+def get_columns(connection, table, schema="main"):
+    return [row[1] for row in connection.execute(
+        "PRAGMA %s.table_info(%s)" % (schema, quote_name(table)))]
+
+
+def get_defaults():
+    """Return {table: {column: default}} of all models"""
+
+    from django.apps import apps
+    from django.db import connection
+    defaults = {}
+    for model in apps.get_models(include_auto_created=True):
+        columns = defaults.setdefault(model._meta.db_table, {})
+        for field in model._meta.local_fields:
+            if field.null:
+                continue
+            columns[field.column] = field.get_db_prep_save(
+                field.get_default(), connection)
+    return defaults
+
+
+def copy_rows(old_path, new_path, defaults):
+    """Replace rows of tables in new_path with those of old_path"""
+
+    connection = sqlite3.connect(new_path)
+    connection.execute("PRAGMA foreign_keys = OFF")
+    connection.execute("ATTACH DATABASE ? AS old", (old_path,))
+    old_tables = set(row[0] for row in connection.execute(
+        "SELECT name FROM old.sqlite_master WHERE type = 'table'"))
+    tables = [row[0] for row in connection.execute(
+        "SELECT name FROM main.sqlite_master WHERE type = 'table' "
+        "AND name NOT LIKE 'sqlite_%' AND name != 'django_migrations'")]
+    errors = []
+    for table in tables:
+        if table not in old_tables:
+            continue
+        old_columns = set(get_columns(connection, table, "old"))
+        try:
+            check_duplicates(connection, table, [
+                columns for columns in get_unique_columns(connection, table)
+                if old_columns.issuperset(columns)], "old")
+        except DuplicateRowsError as e:
+            errors.append(str(e))
+    if errors:
+        connection.close()
+        raise DuplicateRowsError("\n".join(errors))
+
+    with connection:
+        for table in tables:
+            if table not in old_tables:
+                continue
+            old_columns = set(get_columns(connection, table, "old"))
+            columns = [column for column in get_columns(connection, table)
+                       if column in old_columns]
+            added = [column for column in get_columns(connection, table)
+                     if column not in old_columns and
+                     column in defaults.get(table, {})]
+            connection.execute("DELETE FROM main.%s" % quote_name(table))
+            count = connection.execute(
+                "INSERT INTO main.%s (%s) SELECT %s FROM old.%s" % (
+                    quote_name(table),
+                    ", ".join(quote_name(column)
+                              for column in columns + added),
+                    ", ".join([quote_name(column) for column in columns] +
+                              ["?" for column in added]),
+                    quote_name(table)),
+                [defaults[table][column] for column in added]).rowcount
+            print("copied %s rows of %s%s" % (
+                count, table,
+                " (added %s)" % ", ".join(added) if added else ""))
+    connection.close()
+
+
+def main(db_path):
+    import django
+    from django.core.management import call_command
+    from django.db import connections
+
+    db_path = os.path.abspath(db_path)
+    new_path = db_path + ".upgrade"
+    if os.path.exists(new_path):
+        os.remove(new_path)
+    settings.DATABASES['default']['NAME'] = new_path
+    django.setup()
+
+    print("creating %s" % new_path)
+    call_command('migrate', run_syncdb=True, interactive=False, verbosity=0)
+    try:
+        copy_rows(db_path, new_path, get_defaults())
+    except DuplicateRowsError as e:
+        connections.close_all()
+        os.remove(new_path)
+        sys.exit("%s was not upgraded, it violates unique constraints of "
+                 "the current models.\n%s" % (db_path, e))
+    # Add content types and permissions of models new to the database
+    call_command('migrate', run_syncdb=True, interactive=False, verbosity=0)
+    call_command('update_identifiers')
+    connections.close_all()
+    os.replace(new_path, db_path)
+    print("upgraded %s" % db_path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: %s <dbpath>" % sys.argv[0])
+    else:
+        main(sys.argv[1])